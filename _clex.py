@@ -0,0 +1,491 @@
+import re
+import array
+
+# Lexical index of C like source text, shared by the commander modules. This
+# is not a commander module itself, it does not provide any commands. The
+# leading underscore keeps commander from loading it as one.
+
+StateName = 'commander_module_clex_state'
+
+_token_re = re.compile(r'/\*|//|["\'()\[\]{}]')
+_line_end_re = re.compile(u'\r\n|[\n\r\u2029]|$')
+_string_end_re = {
+    '"': re.compile(r'(?:[^"\\\r\n]|\\(?:\r?\n|.)?)*(?:"|(?=[\r\n])|\Z)'),
+    "'": re.compile(r"(?:[^'\\\r\n]|\\(?:\r?\n|.)?)*(?:'|(?=[\r\n])|\Z)")
+}
+
+_openers = {'(': ')', '[': ']', '{': '}'}
+_closers = {')': '(', ']': '[', '}': '{'}
+
+# Kinds of spans, named after the context classes of GtkSourceView
+_kinds = {'comment': 'c', 'string': 's'}
+_kinds_set = set(_kinds.values())
+
+_char_res = {}
+
+# Number of characters lexed or searched at once. The text of a buffer is
+# fetched in windows of this size, larger ones for tokens that do not fit.
+WindowSize = 64 * 1024
+
+class _Offsets:
+    """A sorted array of offsets. The offsets from index gap on are stored
+    without delta, which still has to be added to them. Shifting all offsets
+    after an edit then only touches the offsets between the gap and the edit,
+    which are few when edits are close to each other."""
+
+    def __init__(self, values=()):
+        self.values = array.array('l', values)
+        self.gap = len(self.values)
+        self.delta = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, i):
+        if i >= self.gap:
+            return self.values[i] + self.delta
+
+        return self.values[i]
+
+    def _move_gap(self, i):
+        values = self.values
+        delta = self.delta
+
+        if i > self.gap:
+            values[self.gap:i] = array.array('l', [x + delta for x in values[self.gap:i]])
+        elif i < self.gap:
+            values[i:self.gap] = array.array('l', [x - delta for x in values[i:self.gap]])
+
+        self.gap = i
+
+    def shift(self, i, delta):
+        # Shift the offsets from index i on by delta
+        self._move_gap(i)
+        self.delta += delta
+
+    def splice(self, i, j, values):
+        # Replace the offsets from index i up to j by values
+        if self.gap < j:
+            self._move_gap(j)
+
+        self.values[i:j] = array.array('l', values)
+        self.gap += len(values) - (j - i)
+
+    def bisect_left(self, x):
+        lo = 0
+        hi = len(self.values)
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+
+            if self[mid] < x:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def bisect_right(self, x):
+        lo = 0
+        hi = len(self.values)
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+
+            if x < self[mid]:
+                hi = mid
+            else:
+                lo = mid + 1
+
+        return lo
+
+def _window_tokens(text, pos):
+    # Lex text from pos, which has to be outside of comments and strings.
+    # Yields the kind ('c' for comments, 's' for strings or the bracket), start
+    # and end of every token.
+    while True:
+        m = _token_re.search(text, pos)
+
+        if not m:
+            break
+
+        tok = m.group(0)
+        start = m.start(0)
+
+        if tok == '/*':
+            end = text.find('*/', start + 2)
+
+            if end < 0:
+                end = len(text)
+            else:
+                end += 2
+
+            yield 'c', start, end
+        elif tok == '//':
+            end = _line_end_re.search(text, start).start(0)
+            yield 'c', start, end
+        elif tok in _string_end_re:
+            end = _string_end_re[tok].match(text, start + 1).end(0)
+            yield 's', start, end
+        else:
+            end = start + 1
+            yield tok, start, end
+
+        pos = end
+
+def _tokens(text, pos):
+    # Like _window_tokens, but text only has to support len and slicing. It
+    # is lexed a window at a time, a token reaching the end of a window is
+    # lexed again in a window starting at that token.
+    length = len(text)
+    size = WindowSize
+
+    while pos < length:
+        base = pos
+        window = text[base:base + size]
+        last = base + len(window) >= length
+        cut = -1
+
+        for kind, start, end in _window_tokens(window, 0):
+            if end >= len(window) and not last:
+                cut = start
+                break
+
+            yield kind, base + start, base + end
+            pos = base + end
+
+        if last:
+            break
+
+        if cut < 0:
+            # A token can start at the last character, like the / of /*
+            pos = max(pos, base + len(window) - 1)
+            size = WindowSize
+        elif cut == 0:
+            size *= 2
+        else:
+            pos = base + cut
+            size = WindowSize
+
+class _BufferText:
+    """The text of a buffer, for an Index. Slices are fetched from the buffer
+    when needed, the text is never copied as a whole."""
+
+    def __init__(self, buf):
+        self.buf = buf
+
+    def __len__(self):
+        return self.buf.get_char_count()
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+        else:
+            start = key
+            stop = key + 1
+
+        buf = self.buf
+        text = buf.get_iter_at_offset(start).get_text(buf.get_iter_at_offset(max(start, stop)))
+
+        if isinstance(text, str):
+            text = text.decode('utf-8')
+
+        return text
+
+class Index:
+    """Comments and strings of C like source text, as sorted arrays of start
+    and end offsets with their kinds, together with the offsets of the
+    brackets outside of those. Lookups use bisection instead of walking the
+    text. Edits only lex the text again from just before the edit up to where
+    the tokens are the same as before. The text is a string, or anything else
+    that has a length and can be sliced into one (see _BufferText)."""
+
+    def __init__(self, text, version=0):
+        self.text = text
+        self.length = len(text)
+        self.version = version
+
+        starts = []
+        ends = []
+        brackets = []
+
+        self.kinds = []
+        self.bracket_chars = []
+
+        for kind, start, end in _tokens(text, 0):
+            if kind in _kinds_set:
+                starts.append(start)
+                ends.append(end)
+                self.kinds.append(kind)
+            else:
+                brackets.append(start)
+                self.bracket_chars.append(kind)
+
+        self.starts = _Offsets(starts)
+        self.ends = _Offsets(ends)
+        self.brackets = _Offsets(brackets)
+
+    def edit(self, text, start, end, length):
+        """Update the index for the new text, in which what was from start up
+        to end has been replaced by length characters"""
+        delta = length - (end - start)
+        new_end = start + length
+
+        self.text = text
+        self.length = len(text)
+
+        # Lexing restarts outside of comments and strings, before the edit as
+        # it may extend a token there
+        restart = max(0, start - 1)
+        i = self.span_at(restart)
+
+        if i >= 0:
+            restart = self.starts[i]
+
+        first_span = self.starts.bisect_left(restart)
+        first_bracket = self.brackets.bisect_left(restart)
+
+        spans = []
+        brackets = []
+
+        # Offset from which the old tokens are still valid
+        stop = self.length - delta
+
+        for kind, s, e in _tokens(text, restart):
+            # From a token after the edit, at an old offset outside of any old
+            # comment or string, everything is lexed the same as before
+            if s >= new_end and self.span_at(s - delta) < 0:
+                stop = s - delta
+                break
+
+            if kind in _kinds_set:
+                spans.append((s, e, kind))
+            else:
+                brackets.append((s, kind))
+
+        last_span = self.starts.bisect_left(stop)
+        last_bracket = self.brackets.bisect_left(stop)
+
+        self.starts.splice(first_span, last_span, [x[0] for x in spans])
+        self.starts.shift(first_span + len(spans), delta)
+
+        self.ends.splice(first_span, last_span, [x[1] for x in spans])
+        self.ends.shift(first_span + len(spans), delta)
+
+        self.kinds[first_span:last_span] = [x[2] for x in spans]
+
+        self.brackets.splice(first_bracket, last_bracket, [x[0] for x in brackets])
+        self.brackets.shift(first_bracket + len(brackets), delta)
+
+        self.bracket_chars[first_bracket:last_bracket] = [x[1] for x in brackets]
+
+    def _scan(self, i, step, other):
+        # Walk the brackets from the one at index i in the direction of step
+        # to the one matching it, counting only brackets of the same kind
+        chars = self.bracket_chars
+
+        ch = chars[i]
+        depth = 0
+
+        while 0 <= i < len(chars):
+            c = chars[i]
+
+            if c == ch:
+                depth += 1
+            elif c == other:
+                depth -= 1
+
+                if depth == 0:
+                    return self.brackets[i]
+
+            i += step
+
+        return -1
+
+    def span_at(self, offset):
+        """Index of the comment or string span containing offset, or -1"""
+        i = self.starts.bisect_right(offset) - 1
+
+        if i >= 0 and offset < self.ends[i]:
+            return i
+
+        return -1
+
+    def has_class(self, offset, cls):
+        """Whether offset is in a span of context class cls ('comment' or
+        'string')"""
+        i = self.span_at(offset)
+        return i >= 0 and self.kinds[i] == _kinds[cls]
+
+    def partner(self, offset):
+        """Offset of the bracket matching the one at offset, or -1"""
+        i = self.brackets.bisect_left(offset)
+
+        if i == len(self.brackets) or self.brackets[i] != offset:
+            return -1
+
+        ch = self.bracket_chars[i]
+
+        if ch in _openers:
+            return self._scan(i, 1, _openers[ch])
+        else:
+            return self._scan(i, -1, _closers[ch])
+
+    def search(self, regex, start, end=None, skip=()):
+        """Offset of the first match of the compiled regex between start and
+        end that is not in a span of one of the skip classes, or -1. The text
+        is searched a window at a time, so the regex should not look behind
+        or before the start of a match."""
+        if end is None:
+            end = len(self.text)
+
+        kinds = [_kinds[cls] for cls in skip]
+
+        pos = base = start
+        window = u''
+        size = WindowSize
+
+        while pos < end:
+            m = regex.search(window, pos - base)
+            whole = base + len(window) >= end
+
+            if not m or (m.end(0) >= len(window) and not whole):
+                if whole:
+                    break
+
+                # The match may continue after the window, or be after it
+                base = pos
+                window = self.text[base:min(end, base + size)]
+                size *= 2
+
+                continue
+
+            offset = base + m.start(0)
+            i = self.span_at(offset)
+
+            if i >= 0 and self.kinds[i] in kinds:
+                pos = self.ends[i]
+                continue
+
+            return offset
+
+        return -1
+
+    def find(self, chars, start, end=None, skip=(), nest=None):
+        """Offset of the first of chars between start and end, see search.
+        When nest is an opening bracket, everything from it up to its matching
+        bracket is skipped, and an unmatched one ends the search."""
+        regex = _char_regex(chars + (nest or ''))
+
+        while True:
+            offset = self.search(regex, start, end, skip)
+
+            if offset < 0 or self.text[offset] in chars:
+                return offset
+
+            start = self.partner(offset)
+
+            if start < 0:
+                return -1
+
+            start += 1
+
+    def find_not(self, chars, start, end=None, skip=()):
+        """Offset of the first character that is not one of chars between
+        start and end, see search"""
+        return self.search(_char_regex(chars, True), start, end, skip)
+
+def _char_regex(chars, negate=False):
+    key = (chars, negate)
+
+    if not key in _char_res:
+        if negate:
+            _char_res[key] = re.compile(u'[^%s]' % (re.escape(chars),))
+        else:
+            _char_res[key] = re.compile(u'[%s]' % (re.escape(chars),))
+
+    return _char_res[key]
+
+class _State:
+    def __init__(self):
+        self.version = 0
+        self.index = None
+
+        # The region that changed since the index was last updated, as its
+        # start, its end before and its end after the changes
+        self.dirty = None
+
+def _on_changed(buf, state):
+    state.version += 1
+
+def _add_edit(state, start, end, length):
+    # Merge the replacement of the text from start up to end by length
+    # characters into the changed region
+    if not state.index:
+        return
+
+    if state.dirty is None:
+        state.dirty = (start, end, start + length)
+        return
+
+    s, old_end, new_end = state.dirty
+
+    state.dirty = (min(s, start),
+                   old_end + max(0, end - new_end),
+                   max(new_end, end) + length - (end - start))
+
+def _on_insert_text(buf, piter, text, length, state):
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+
+    _add_edit(state, piter.get_offset(), piter.get_offset(), len(text))
+
+def _on_delete_range(buf, start, end, state):
+    _add_edit(state, min(start.get_offset(), end.get_offset()),
+              max(start.get_offset(), end.get_offset()), 0)
+
+def _get_state(buf):
+    state = getattr(buf, StateName, None)
+
+    if state is None:
+        state = _State()
+        setattr(buf, StateName, state)
+
+        # The edits are recorded before they are made, while their offsets
+        # still apply to the text the index knows
+        buf.connect('insert-text', _on_insert_text, state)
+        buf.connect('delete-range', _on_delete_range, state)
+        buf.connect('changed', _on_changed, state)
+
+    return state
+
+def version(buf):
+    """Returns a number that changes whenever buf changes"""
+    return _get_state(buf).version
+
+def get(buf):
+    """Returns the index of the current text of buf. After the buffer changed,
+    only the region that changed is lexed again, fetching just the text that
+    is needed from the buffer."""
+    state = _get_state(buf)
+    index = state.index
+
+    if index and index.version != state.version and state.dirty:
+        start, end, new_end = state.dirty
+
+        if index.length + new_end - end != buf.get_char_count():
+            # Missed an edit somehow, start over
+            index = None
+        else:
+            index.edit(_BufferText(buf), start, end, new_end - start)
+            index.version = state.version
+
+    state.dirty = None
+
+    if index is None or index.version != state.version:
+        index = Index(_BufferText(buf), state.version)
+
+    state.index = index
+    return index
+
+# vi:ts=4:et
@@ -3,34 +3,26 @@ import commander.commands.completion
 import commander.commands.result
 import commander.commands.exceptions
 
+import _clex
+
 __commander_module__ = True
 
 def _search_paren(piter, search_for, skip_classes, last=None, stackon=None, stackoff=None):
-    buf = piter.get_buffer()
-    level = 0
-
-    while True:
-        if last and piter.compare(last) >= 0:
-            return False
-
-        ch = piter.get_char()
+    # Text from stackon up to its matching stackoff is skipped, as found in the
+    # lexical index of the buffer
+    index = _clex.get(piter.get_buffer())
 
-        if level == 0 and ch == search_for:
-            break
-
-        if ch == stackon:
-            level += 1
-        elif ch == stackoff:
-            level -= 1
+    if last:
+        end = last.get_offset()
+    else:
+        end = None
 
-        if not piter.forward_char():
-            return False
+    offset = index.find(search_for, piter.get_offset(), end, skip_classes, stackon)
 
-        for skip in skip_classes:
-            if buf.iter_has_context_class(piter, skip):
-                if not buf.iter_forward_to_context_class_toggle(piter, skip):
-                    return False
+    if offset < 0:
+        return False
 
+    piter.set_offset(offset)
     return True
 
 def break_function(view):
@@ -3,13 +3,126 @@ import commander.commands.completion
 import commander.commands.result
 import commander.commands.exceptions
 
+import os
 import re
+import mmap
+import sre_parse
+import sre_constants
+import bisect
+import time
+import array
+import itertools
+import collections
+import Queue
+import multiprocessing
+import multiprocessing.pool
+
+try:
+    from gi.repository import GLib as glib
+    from gi.repository import Gio as gio
+except ImportError:
+    import glib
+    import gio
+
+import _clex
 
 __commander_module__ = True
 
 HideTagName = 'CommanderModuleGrepHideTag'
 ZoomOutTagName = 'CommanderModuleGrepZoomOutTag'
 HighlightTagName = 'CommanderModuleGrepHighlightTag'
+StateName = 'commander_module_grep_state'
+FilesStateName = 'commander_module_grep_files'
+
+# Lines matched at once, and the time in seconds that grep may block the main
+# loop before yielding to it again
+ChunkLines = 2000
+TimeSlice = 0.05
+
+# Number of compiled patterns kept around for reuse
+PatternCacheSize = 32
+
+# Lines around the visible part of the view that are handled first with --view
+ViewMargin = 100
+
+# Number of recent grep results kept per document
+ResultCacheSize = 8
+
+# Maximum number of highlighted matches on a single line, such that lines
+# with huge numbers of matches cannot stall the editor
+MaxHighlightsPerLine = 200
+
+# Documents of at least ParallelThreshold characters are matched in chunks of
+# ParallelChunkLines lines by ParallelProcesses worker processes (None for the
+# number of CPUs)
+ParallelThreshold = 16 * 1024 * 1024
+ParallelChunkLines = 20000
+ParallelProcesses = None
+
+# Characters sampled at the start and at the end of what follow mode already
+# processed, to recognize a reloaded document that only grew. A reload that
+# is still loading is waited on for FollowReloadDelay milliseconds.
+FollowSample = 4096
+FollowReloadDelay = 500
+
+# Number of threads used to match documents in grep.all
+Workers = 4
+
+# Files larger than FilesMaxSize bytes are skipped by grep.files, as are files
+# with a NUL byte in their first FilesBinarySample bytes
+FilesMaxSize = 256 * 1024 * 1024
+FilesBinarySample = 8192
+
+# Seconds a regular expression that is prone to catastrophic backtracking may
+# spend on a single line before grep gives up on it. Such expressions are
+# matched in a worker process that can be stopped.
+MatchTimeout = 2.0
+
+# Maximum number of instructions of a pattern compiled for --linear
+LinearProgramSize = 10000
+
+_line_end_re = re.compile(u'\r\n|[\n\r\u2029]')
+_run_re = re.compile('1+|0+')
+_ones_re = re.compile('1+')
+_operator_re = re.compile(r'\s+([&|])\s+')
+_option_re = re.compile(r'\s*(--?[A-Za-z]*)(?:\s+|$)')
+_value_re = re.compile(r'(\S+)\s*')
+_result_re = re.compile(u'(.+?):([0-9]+): ')
+
+# Options of the commands filtering the document, and whether they take a value
+_grep_options = {
+    '--view': False,
+    '--linear': False,
+    '-A': True,
+    '-B': True,
+    '-C': True,
+    '--comments': False,
+    '--strings': False,
+    '--code': False
+}
+
+# Options restricting matches to a part of the syntax, and its context class
+_syntax_options = {
+    '--comments': 'comment',
+    '--strings': 'string',
+    '--code': 'code'
+}
+
+_all_options = {
+    '--linear': False
+}
+
+_count_options = {
+    '--linear': False
+}
+
+_extract_options = {
+    '-n': False,
+    '--linear': False
+}
+
+_patterns = collections.OrderedDict()
+_parallel_snapshot = None
 
 def _get_tag(buf, name, callback=None, **args):
     table = buf.get_tag_table()
@@ -49,124 +162,3069 @@ def _create_highlight_tag(buf):
 def _get_highlight_tag(buf):
     return _get_tag(buf, HighlightTagName, _create_highlight_tag)
 
-def _grep_action_hide(view, start, end):
+def _grep_action_hide(buf, start, end):
     # Apply tag that makes line invisible
-    buf = view.get_buffer()
     tag = _get_invisible_tag(buf)
 
-    buf.apply_tag(tag, start, end)
+    _apply_tag(buf, tag, start, end)
 
-def _grep_action_show(view, start, end):
-    buf = view.get_buffer()
+def _grep_action_show(buf, start, end):
     tag = _get_invisible_tag(buf)
 
-    buf.remove_tag(tag, start, end)
+    _remove_tag(buf, tag, start, end)
 
-def _grep_action_zoomin(view, start, end):
-    buf = view.get_buffer()
+def _grep_action_zoomin(buf, start, end):
     tag = _get_zoomout_tag(buf)
 
-    buf.remove_tag(tag, start, end)
+    _remove_tag(buf, tag, start, end)
 
-def _grep_action_zoomout(view, start, end):
-    buf = view.get_buffer()
+def _grep_action_zoomout(buf, start, end):
     tag = _get_zoomout_tag(buf)
 
-    buf.apply_tag(tag, start, end)
+    _apply_tag(buf, tag, start, end)
 
-def _highlight(view, start, end, matches):
-    buf = view.get_buffer()
-    tag = _get_highlight_tag(buf)
+class _RegexMatcher:
+    def __init__(self, reg, risky=False, ahead=False):
+        self.regex = reg
+        self.risky = risky
+        self.ahead = ahead
 
-    for match in matches:
-        st = start.copy()
-        ed = start.copy()
+    def spans(self, text, pos, endpos):
+        for m in self.regex.finditer(text, pos, endpos):
+            yield m.span(0)
 
-        st.forward_chars(match.start(0))
-        ed.forward_chars(match.end(0))
+class _LiteralMatcher:
+    risky = False
+    ahead = False
 
-        buf.apply_tag(tag, st, ed)
+    def __init__(self, literal):
+        self.literal = literal
 
-def _unhighlight(view, start, end, matches):
-    buf = view.get_buffer()
-    tag = _get_highlight_tag(buf)
+    def spans(self, text, pos, endpos):
+        find = text.find
+        literal = self.literal
+        n = len(literal)
 
-    for match in matches:
-        st = start.copy()
-        ed = start.copy()
+        i = find(literal, pos, endpos)
 
-        st.forward_chars(match.start(0))
-        ed.forward_chars(match.end(0))
+        while i >= 0:
+            yield (i, i + n)
+            i = find(literal, i + n, endpos)
 
-        buf.remove_tag(tag, st, ed)
+# Instructions of the programs run by _LinearMatcher
+_CHAR, _SPLIT, _JMP, _ASSERT, _MATCH = range(5)
 
-def _grep(view, regex, match_action, non_match_action):
-    buf = view.get_buffer()
-    start = buf.get_start_iter()
+_categories = {
+    sre_constants.CATEGORY_DIGIT: (u'0123456789', False),
+    sre_constants.CATEGORY_NOT_DIGIT: (u'0123456789', True),
+    sre_constants.CATEGORY_SPACE: (u' \t\n\r\f\v', False),
+    sre_constants.CATEGORY_NOT_SPACE: (u' \t\n\r\f\v', True),
+    sre_constants.CATEGORY_WORD: (u'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_', False),
+    sre_constants.CATEGORY_NOT_WORD: (u'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_', True)
+}
+
+def _is_word(ch):
+    return ch.isalnum() or ch == u'_'
+
+def _char_test(op, av, icase):
+    # Returns a function testing a single character against a parsed literal,
+    # any or character class
+    if op == sre_constants.ANY:
+        return lambda ch: ch != u'\n'
+
+    if op in (sre_constants.LITERAL, sre_constants.NOT_LITERAL):
+        items = [(sre_constants.LITERAL, av)]
+        negate = (op == sre_constants.NOT_LITERAL)
+    else:
+        items = av
+        negate = False
+
+    chars = set()
+    ranges = []
+    categories = []
+
+    for iop, iav in items:
+        if iop == sre_constants.NEGATE:
+            negate = True
+        elif iop == sre_constants.LITERAL:
+            chars.add(unichr(iav))
+        elif iop == sre_constants.RANGE:
+            ranges.append((unichr(iav[0]), unichr(iav[1])))
+        elif iop == sre_constants.CATEGORY and iav in _categories:
+            categories.append(_categories[iav])
+        else:
+            raise commands.exceptions.Execute('Character class not supported with --linear')
+
+    if icase:
+        chars = set([x.lower() for x in chars] + [x.upper() for x in chars])
+
+    def test(ch):
+        if icase:
+            variants = (ch, ch.lower(), ch.upper())
+        else:
+            variants = (ch,)
+
+        for c in variants:
+            if c in chars:
+                return not negate
+
+            for lo, hi in ranges:
+                if lo <= c <= hi:
+                    return not negate
+
+        for members, cnegate in categories:
+            if (ch in members) != cnegate:
+                return not negate
+
+        return negate
+
+    return test
+
+def _linear_compile(sub, prog, icase):
+    # Compile a parsed regular expression into instructions for a Pike VM,
+    # appending them to prog
+    for op, av in sub:
+        if op in (sre_constants.LITERAL, sre_constants.NOT_LITERAL, sre_constants.ANY, sre_constants.IN):
+            prog.append((_CHAR, _char_test(op, av, icase)))
+        elif op == sre_constants.SUBPATTERN:
+            _linear_compile(av[-1], prog, icase)
+        elif op == sre_constants.BRANCH:
+            alternatives = av[1]
+            jumps = []
+
+            for alt in alternatives[:-1]:
+                split = len(prog)
+                prog.append(None)
+
+                _linear_compile(alt, prog, icase)
+
+                jumps.append(len(prog))
+                prog.append(None)
+
+                prog[split] = (_SPLIT, split + 1, len(prog))
+
+            _linear_compile(alternatives[-1], prog, icase)
+
+            for jump in jumps:
+                prog[jump] = (_JMP, len(prog))
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            lo, hi, item = av
+
+            for i in xrange(lo):
+                _linear_compile(item, prog, icase)
+
+            if hi == sre_constants.MAXREPEAT:
+                split = len(prog)
+                prog.append(None)
+
+                _linear_compile(item, prog, icase)
+
+                prog.append((_JMP, split))
+                prog[split] = (_SPLIT, split + 1, len(prog))
+            else:
+                splits = []
+
+                for i in xrange(hi - lo):
+                    splits.append(len(prog))
+                    prog.append(None)
+
+                    _linear_compile(item, prog, icase)
+
+                for split in splits:
+                    prog[split] = (_SPLIT, split + 1, len(prog))
+        elif op == sre_constants.AT:
+            prog.append((_ASSERT, av))
+        else:
+            raise commands.exceptions.Execute('Regular expression not supported with --linear (%s)' % (op,))
+
+        if len(prog) > LinearProgramSize:
+            raise commands.exceptions.Execute('Regular expression too large for --linear')
+
+class _LinearMatcher:
+    """Matches a regular expression in time linear in the length of the text,
+    by simulating all ways of matching at once (a Pike VM). Only the subset of
+    the syntax without back references and look around assertions is
+    supported. Matches are leftmost-longest instead of leftmost-first, which
+    gives the same matching lines."""
+
+    risky = False
+
+    def __init__(self, regex):
+        try:
+            tree = sre_parse.parse(regex, re.M)
+        except Exception, e:
+            raise commands.exceptions.Execute('Invalid regular expression: ' + str(e))
+
+        self.prog = []
+        self.ahead = _looks_ahead(tree)
+
+        _linear_compile(tree, self.prog, tree.pattern.flags & re.I)
+        self.prog.append((_MATCH,))
+
+    def _assert(self, kind, text, i, pos, endpos):
+        if kind in (sre_constants.AT_BEGINNING, sre_constants.AT_BEGINNING_LINE):
+            return i == 0 or text[i - 1] == u'\n'
+        elif kind in (sre_constants.AT_END, sre_constants.AT_END_LINE):
+            return i == endpos or text[i] == u'\n'
+        elif kind == sre_constants.AT_BEGINNING_STRING:
+            return i == 0
+        elif kind == sre_constants.AT_END_STRING:
+            return i == endpos
+
+        before = i > pos and _is_word(text[i - 1])
+        after = i < endpos and _is_word(text[i])
+
+        return (before != after) == (kind == sre_constants.AT_BOUNDARY)
+
+    def _add(self, threads, seen, pc, start, text, i, pos, endpos):
+        # Follow the jumps, splits and assertions from pc, adding a thread for
+        # every instruction that consumes a character or matches. A pc that was
+        # already reached at this position is skipped, such that the thread
+        # that started first wins.
+        prog = self.prog
+        stack = [pc]
+
+        while stack:
+            pc = stack.pop()
+
+            if pc in seen:
+                continue
+
+            seen.add(pc)
+            inst = prog[pc]
+
+            if inst[0] == _JMP:
+                stack.append(inst[1])
+            elif inst[0] == _SPLIT:
+                stack.append(inst[2])
+                stack.append(inst[1])
+            elif inst[0] == _ASSERT:
+                if self._assert(inst[1], text, i, pos, endpos):
+                    stack.append(pc + 1)
+            else:
+                threads.append((pc, start))
+
+    def spans(self, text, pos, endpos):
+        prog = self.prog
+
+        # The longest match found for every start position
+        ends = {}
+
+        threads = []
+        self._add(threads, set(), 0, pos, text, pos, pos, endpos)
+
+        for i in xrange(pos, endpos + 1):
+            if i < endpos:
+                ch = text[i]
+            else:
+                ch = None
+
+            nthreads = []
+            seen = set()
+
+            for pc, start in threads:
+                inst = prog[pc]
+
+                if inst[0] == _MATCH:
+                    if ends.get(start, -1) < i:
+                        ends[start] = i
+                elif ch is not None and inst[1](ch):
+                    self._add(nthreads, seen, pc + 1, start, text, i + 1, pos, endpos)
+
+            if ch is not None:
+                # A new attempt starts at every position
+                self._add(nthreads, seen, 0, i + 1, text, i + 1, pos, endpos)
+
+            threads = nthreads
+
+        last = pos
+
+        for start in sorted(ends):
+            if start < last:
+                continue
+
+            end = ends[start]
+            yield (start, end)
+
+            last = max(end, start + 1)
+
+def _char_set(op, av, icase):
+    # The characters a parsed literal or character class can match, or None
+    # when there are too many to list
+    if op == sre_constants.LITERAL:
+        items = [(op, av)]
+    elif op == sre_constants.IN:
+        items = av
+    else:
+        return None
+
+    chars = set()
+
+    for iop, iav in items:
+        if iop == sre_constants.LITERAL:
+            chars.add(unichr(iav))
+        elif iop == sre_constants.RANGE and iav[1] - iav[0] < 256:
+            chars.update([unichr(c) for c in xrange(iav[0], iav[1] + 1)])
+        elif iop == sre_constants.CATEGORY and iav in _categories and not _categories[iav][1]:
+            chars.update(_categories[iav][0])
+        else:
+            return None
+
+    if icase:
+        chars = set([c.lower() for c in chars])
+
+    return chars
+
+def _union(a, b):
+    if a is None or b is None:
+        return None
+
+    return a | b
+
+def _overlap(a, b):
+    # None stands for any character
+    if a is None or b is None:
+        return (a is None or len(a) > 0) and (b is None or len(b) > 0)
+
+    return len(a & b) > 0
+
+def _first_chars(sub, icase):
+    # The characters a match of sub can start with, and whether sub can match
+    # the empty string
+    chars = set()
+
+    for op, av in sub:
+        first, empty = _first_chars_op(op, av, icase)
+        chars = _union(chars, first)
+
+        if not empty:
+            return chars, False
+
+    return chars, True
+
+def _first_chars_op(op, av, icase):
+    if op in (sre_constants.LITERAL, sre_constants.NOT_LITERAL, sre_constants.ANY, sre_constants.IN):
+        return _char_set(op, av, icase), False
+    elif op == sre_constants.SUBPATTERN:
+        return _first_chars(av[-1], icase)
+    elif op == sre_constants.BRANCH:
+        chars = set()
+        empty = False
+
+        for alt in av[1]:
+            first, e = _first_chars(alt, icase)
+            chars = _union(chars, first)
+            empty = empty or e
+
+        return chars, empty
+    elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+        first, empty = _first_chars(av[2], icase)
+        return first, empty or av[0] == 0
+    elif op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+        return None, True
+
+    # Anchors and lookarounds do not consume anything
+    return set(), True
+
+def _all_chars(sub, icase):
+    # All characters a match of sub can contain
+    chars = set()
+
+    for op, av in sub:
+        if op in (sre_constants.LITERAL, sre_constants.NOT_LITERAL, sre_constants.ANY, sre_constants.IN):
+            chars = _union(chars, _char_set(op, av, icase))
+        elif op == sre_constants.SUBPATTERN:
+            chars = _union(chars, _all_chars(av[-1], icase))
+        elif op == sre_constants.BRANCH:
+            for alt in av[1]:
+                chars = _union(chars, _all_chars(alt, icase))
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            chars = _union(chars, _all_chars(av[2], icase))
+        elif op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+            return None
+
+        if chars is None:
+            return None
+
+    return chars
+
+def _is_unbounded(sub):
+    # Whether a parsed pattern contains a repeat without an upper bound
+    for op, av in sub:
+        if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            if av[1] == sre_constants.MAXREPEAT or _is_unbounded(av[2]):
+                return True
+        elif op == sre_constants.SUBPATTERN:
+            if _is_unbounded(av[-1]):
+                return True
+        elif op == sre_constants.BRANCH:
+            for alt in av[1]:
+                if _is_unbounded(alt):
+                    return True
+
+    return False
+
+def _is_risky(regex):
+    # Backtracking takes exponential time when a repeated part can match the
+    # same text in more than one way: a part of variable length inside it that
+    # can take characters from what follows (like (a+)+, (\w+\s?)+ or (a|aa)+),
+    # or alternatives that start alike. Back references are never safe.
+    # Unbounded repeats next to each other that can take the same characters
+    # (like .*.*.*= or \s*\s*x) take polynomial time, which is as bad on long
+    # lines.
+    def walk(sub, follow, repeated, icase):
+        items = list(sub)
+
+        # The characters that the unbounded repeats right before an item can
+        # take, with only parts that can be empty in between
+        pending = set()
+
+        for op, av in items:
+            first, empty = _first_chars_op(op, av, icase)
+
+            if _is_unbounded([(op, av)]):
+                chars = _all_chars([(op, av)], icase)
+
+                if _overlap(chars, pending):
+                    return True
+
+                pending = _union(pending, chars) if empty else chars
+            elif not empty:
+                pending = set()
+
+        # The characters that can follow each of the items
+        follows = [None] * len(items)
+
+        for i in xrange(len(items) - 1, -1, -1):
+            follows[i] = follow
+            first, empty = _first_chars_op(items[i][0], items[i][1], icase)
+
+            follow = first if not empty else _union(first, follow)
+
+        for (op, av), follow in zip(items, follows):
+            if op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+                return True
+            elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+                body = av[2]
+
+                if repeated and av[0] != av[1] and _overlap(_all_chars(body, icase), follow):
+                    return True
+
+                if av[1] > 1:
+                    # After an iteration comes either another one or what
+                    # follows the repeat
+                    if walk(body, _union(_first_chars(body, icase)[0], follow), True, icase):
+                        return True
+                elif walk(body, follow, repeated, icase):
+                    return True
+            elif op == sre_constants.BRANCH:
+                alts = av[1]
+
+                if repeated:
+                    # Common prefixes are taken out of the alternatives by the
+                    # parser, (a|aa) is parsed as a(|a)
+                    first, empty = _first_chars_op(op, av, icase)
+
+                    if empty and _overlap(_all_chars([(op, av)], icase), follow):
+                        return True
+
+                    firsts = [_first_chars(alt, icase)[0] for alt in alts]
+
+                    for i in xrange(len(firsts)):
+                        for j in xrange(i):
+                            if _overlap(firsts[i], firsts[j]):
+                                return True
+
+                for alt in alts:
+                    if walk(alt, follow, repeated, icase):
+                        return True
+            elif op == sre_constants.SUBPATTERN:
+                if walk(av[-1], follow, repeated, icase):
+                    return True
+            elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+                if walk(av[1], set(), False, icase):
+                    return True
+
+        return False
+
+    try:
+        parsed = sre_parse.parse(regex, re.M)
+        return walk(parsed, set(), False, bool(parsed.pattern.flags & re.I))
+    except Exception:
+        return False
+
+def _looks_ahead(sub):
+    # Whether a parsed pattern looks past the end of a match, with $ or a look
+    # ahead assertion, where it would see the end of the line
+    for op, av in sub:
+        if op == sre_constants.AT:
+            if av in (sre_constants.AT_END, sre_constants.AT_END_LINE, sre_constants.AT_END_STRING):
+                return True
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            if av[0] == 1:
+                return True
+        elif op == sre_constants.SUBPATTERN:
+            if _looks_ahead(av[-1]):
+                return True
+        elif op == sre_constants.BRANCH:
+            for alt in av[1]:
+                if _looks_ahead(alt):
+                    return True
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            if _looks_ahead(av[2]):
+                return True
+        elif op == sre_constants.GROUPREF_EXISTS:
+            for alt in av[1:]:
+                if alt and _looks_ahead(alt):
+                    return True
+
+    return False
+
+class _CompositeMatcher:
+    """Boolean combination of patterns, as a list of alternatives (|) that are
+    each a list of terms (&). A term is a pair of a matcher and whether it is
+    negated (!)."""
+
+    def __init__(self, alternatives):
+        self.alternatives = alternatives
+        self.risky = True in [m.risky for terms in alternatives for m, negate in terms]
+
+    def match_lines(self, text, starts, first, last):
+        full = (1 << (last - first)) - 1
+        bits = 0
+
+        spans = []
+
+        # Every term is matched once into a bitset of the lines, after which
+        # the expression is evaluated on the bitsets
+        for terms in self.alternatives:
+            conj = full
+
+            for matcher, negate in terms:
+                mask, sp = _match_lines(matcher, text, starts, first, last)
+                tbits = _mask_to_bits(mask)
+
+                if negate:
+                    tbits ^= full
+                else:
+                    spans.append(sp)
+
+                conj &= tbits
+
+            bits |= conj
+
+        if len(spans) == 1:
+            spans = spans[0]
+        else:
+            it = [iter(sp) for sp in spans]
+            pairs = sorted(itertools.chain(*[itertools.izip(x, x) for x in it]))
+
+            spans = array.array('l', itertools.chain(*pairs))
+
+        mask = _bits_to_mask(bits, last - first)
+
+        return mask, self._keep_spans(text, starts, first, mask, spans)
+
+    def _keep_spans(self, text, starts, first, mask, spans):
+        # Only the matches on lines that the whole expression accepts
+        kept = array.array('l')
+
+        lo = hi = 0
+        keep = False
+
+        for i in xrange(0, len(spans), 2):
+            s = spans[i]
+
+            if not lo <= s < hi:
+                line = _line_at(starts, s)
+                lo = done = starts[line]
+
+                if line + 1 < len(starts):
+                    hi = starts[line + 1]
+                else:
+                    hi = len(text) + 1
+
+                keep = mask[line - first] == '1'
+
+            if keep:
+                kept.append(s)
+                kept.append(spans[i + 1])
+
+        return kept
+
+def _split_operators(regex):
+    # Split a filter on its operators like re.split would, in terms and the
+    # operators between them. Only operators outside of groups, character
+    # classes and escapes count.
+    parts = []
+    depth = 0
+    start = 0
+    pos = 0
+
+    while pos < len(regex):
+        c = regex[pos]
+
+        if c == '\\':
+            pos += 2
+            continue
+
+        if c == '[':
+            # A ] right at the start of a class is part of it
+            pos += 1
+
+            if regex[pos:pos + 1] == '^':
+                pos += 1
+
+            if regex[pos:pos + 1] == ']':
+                pos += 1
+
+            while pos < len(regex) and regex[pos] != ']':
+                pos += 2 if regex[pos] == '\\' else 1
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth = max(depth - 1, 0)
+        elif depth == 0:
+            m = _operator_re.match(regex, pos)
+
+            if m:
+                parts.extend([regex[start:pos], m.group(1)])
+                start = pos = m.end(0)
+                continue
+
+        pos += 1
+
+    parts.append(regex[start:])
+    return parts
+
+def _parse_composite(regex, linear=False):
+    # Split a filter such as 'A & !B | C' in its alternatives of terms, returns
+    # None for a single plain regex. Operators need to be surrounded by white
+    # space so they do not clash with the regex syntax, a single term is only
+    # a filter when it is negated.
+    parts = _split_operators(regex)
+
+    if len(parts) == 1 and not regex.strip().startswith('!'):
+        return None
+
+    alternatives = [[]]
+
+    for i in range(0, len(parts), 2):
+        term = parts[i].strip()
+        negate = term.startswith('!')
+
+        if negate:
+            term = term[1:].strip()
+
+        if not term:
+            raise commands.exceptions.Execute('Invalid filter, empty term')
+
+        alternatives[-1].append((_compile(term, linear), negate))
+
+        if i + 1 < len(parts) and parts[i + 1] == '|':
+            alternatives.append([])
+
+    return alternatives
+
+def _parse_literals(regex):
+    # Returns the alternatives of a regex which is nothing more than a list of
+    # literals separated by |, or None if it uses any other regex syntax
+    words = []
+    word = []
+
+    i = 0
+
+    while i < len(regex):
+        c = regex[i]
+
+        if c == '\\':
+            if i + 1 == len(regex) or regex[i + 1].isalnum():
+                return None
+
+            word.append(regex[i + 1])
+            i += 1
+        elif c == '|':
+            if not word:
+                return None
+
+            words.append(''.join(word))
+            word = []
+        elif c in '.^$*+?{}[]()':
+            return None
+        else:
+            word.append(c)
+
+        i += 1
+
+    if not word:
+        return None
+
+    words.append(''.join(word))
+    return words
+
+def _trie_regex(words):
+    # Build a regex for a list of literals in which common prefixes are shared,
+    # such that matching never has to try every alternative at every position
+    trie = {}
+
+    for word in words:
+        node = trie
+
+        for c in word:
+            node = node.setdefault(c, {})
+
+        node[''] = None
+
+    def build(node):
+        alts = [re.escape(c) + build(node[c]) for c in sorted(node) if c]
+
+        if not alts:
+            return ''
+
+        if len(alts) == 1 and not '' in node:
+            return alts[0]
+
+        ret = '(?:' + '|'.join(alts) + ')'
+
+        if '' in node:
+            ret += '?'
+
+        return ret
+
+    return build(trie)
+
+def _create_matcher(regex, linear=False):
+    alternatives = _parse_composite(regex, linear)
+
+    if alternatives:
+        return _CompositeMatcher(alternatives)
+
+    words = _parse_literals(regex)
+
+    if words and len(words) == 1:
+        return _LiteralMatcher(words[0])
+
+    if linear:
+        return _LinearMatcher(regex)
+
+    if words and max([len(x) for x in words]) < 256:
+        regex = _trie_regex(set(words))
 
     try:
-        reg = re.compile(regex)
+        reg = re.compile(regex, re.M)
     except Exception, e:
         raise commands.exceptions.Execute('Invalid regular expression: ' + str(e))
 
-    while True:
-        end = start.copy()
+    return _RegexMatcher(reg, _is_risky(regex), _looks_ahead(sre_parse.parse(regex, re.M)))
 
-        if not end.forward_line():
-            end.forward_to_line_end()
+def _compile(regex, linear=False):
+    # Compiled patterns are shared by all grep commands, the least recently
+    # used one is dropped when the cache is full
+    key = (_unicode(regex), linear)
+    matcher = _patterns.pop(key, None)
 
-        text = start.get_text(end)
-        piter = list(reg.finditer(text))
+    if matcher is None:
+        matcher = _create_matcher(key[0], linear)
 
-        if not piter:
-            _unhighlight(view, start, end, piter)
-            non_match_action(view, start, end)
-        else:
-            _highlight(view, start, end, piter)
-            match_action(view, start, end)
+        if len(_patterns) >= PatternCacheSize:
+            _patterns.popitem(False)
 
-        if not start.forward_line():
-            break
+    _patterns[key] = matcher
+    return matcher
 
-def __default__(view, argstr):
-    """Hide non-matching lines in document: grep &lt;regex&gt;
+def _mask_to_bits(mask):
+    # Pack a mask into an integer with bit n set for every matching line n
+    mask = str(mask)[::-1]
 
-Matches a regular expression on each line and hides all text that does not
-match. For the revere (hiding matches) use grep.hide"""
-    yield _grep(view, argstr, _grep_action_show, _grep_action_hide)
+    if not mask:
+        return 0
 
-def hide(view, argstr):
-    """Hide matching lines in document: grep.hide &lt;regex&gt;
+    return int(mask, 2)
 
-Matches a regular expression on each line and hides all matches. For
-the reverse (hiding lines that do not match) use grep.show"""
-    yield _grep(view, argstr, _grep_action_hide, _grep_action_show)
+def _bits_to_mask(bits, lines):
+    mask = bin(bits)[:1:-1]
 
-def zoomin(view, argstr):
-    """Zoom in on matching lines in document: grep.zoomin &lt;regex&gt;
+    return mask.ljust(lines, '0')[:lines]
 
-Matches a regular expression on each line and magnifies all matching lines
-with respect to the non-matching lines. For the reverse, use grep.zoomout"""
-    yield _grep(view, argstr, _grep_action_zoomin, _grep_action_zoomout)
+class _GrepResult:
+    """The lines (as a bitset) and the match spans of a pattern, valid for a
+    single version of a document."""
 
-def zoomout(view, argstr):
-    """Zoom out on matching lines in document: grep.zoomout &lt;regex&gt;
+    def __init__(self, matcher, version, mask, spans):
+        self.matcher = matcher
+        self.version = version
+        self.lines = len(mask)
+        self.bits = _mask_to_bits(mask)
+        self.spans = spans
 
-Matches a regular expression on each line and minifies all matching lines
-with respect to the non-matching lines. For the reverse, use grep.zoomin"""
-    yield _grep(view, argstr, _grep_action_zoomout, _grep_action_zoomin)
+        self._offsets = None
 
-def clear(view):
-    """Clear the last grep command: grep.clear
+    def mask(self):
+        return _bits_to_mask(self.bits, self.lines)
 
-Clear the actions resulting from the last grep command."""
-    buf = view.get_buffer()
+    def matching_lines(self):
+        return bin(self.bits).count('1')
+
+    def offsets(self):
+        # Sorted start offsets of all matches, for bisecting
+        if self._offsets is None:
+            self._offsets = self.spans[::2]
+
+        return self._offsets
+
+class _GrepState:
+    def __init__(self):
+        self.matcher = None
+        self.match_action = None
+        self.non_match_action = None
+        self.job = None
+
+        # Number of lines of context shown before and after matching lines
+        self.context = (0, 0)
+
+        # Incremented on every change, results are only valid for a version
+        self.version = 0
+        self.results = collections.OrderedDict()
+
+        # The ranges grep tagged, per tag. Only valid for ranges_version.
+        self.ranges = {}
+        self.ranges_version = -1
+
+        self.handlers = []
+        self.dirty = None
+        self.idle_id = 0
+
+        self.follow = None
+
+        # Restricts the matches to comments, strings or code when set
+        self.syntax = None
+        self.syntaxes = {}
+
+def _get_state(buf):
+    # The state is kept on the buffer wrapper itself so that it lives exactly
+    # as long as the document does. It must never reference the buffer.
+    state = getattr(buf, StateName, None)
+
+    if state is None:
+        state = _GrepState()
+        setattr(buf, StateName, state)
+
+        buf.connect('changed', _on_buffer_changed, state)
+
+    return state
+
+class _Ranges:
+    """Sorted list of disjoint ranges of offsets, ranges that touch are
+    merged."""
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def __iter__(self):
+        return itertools.izip(self.starts, self.ends)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def add(self, s, e):
+        if s >= e:
+            return
+
+        if not self.starts or s > self.ends[-1]:
+            self.starts.append(s)
+            self.ends.append(e)
+            return
+
+        # Ranges i up to j touch or overlap with s-e
+        i = bisect.bisect_left(self.ends, s)
+        j = bisect.bisect_right(self.starts, e)
+
+        if i < j:
+            s = min(s, self.starts[i])
+            e = max(e, self.ends[j - 1])
+
+        self.starts[i:j] = [s]
+        self.ends[i:j] = [e]
+
+    def remove(self, s, e):
+        """Remove s-e from the ranges, returns whether anything was removed"""
+        if s >= e:
+            return False
+
+        # Ranges i up to j overlap with s-e
+        i = bisect.bisect_right(self.ends, s)
+        j = bisect.bisect_left(self.starts, e)
+
+        if i >= j:
+            return False
+
+        starts = []
+        ends = []
+
+        if self.starts[i] < s:
+            starts.append(self.starts[i])
+            ends.append(s)
+
+        if self.ends[j - 1] > e:
+            starts.append(e)
+            ends.append(self.ends[j - 1])
+
+        self.starts[i:j] = starts
+        self.ends[i:j] = ends
+
+        return True
+
+def _find_ranges(buf, tag):
+    # Walk the toggles of the tag, which only visits the tagged ranges
+    ranges = _Ranges()
+    piter = buf.get_start_iter()
+
+    while piter.has_tag(tag) or piter.forward_to_tag_toggle(tag):
+        start = piter.get_offset()
+        piter.forward_to_tag_toggle(tag)
+
+        ranges.add(start, piter.get_offset())
+
+        if piter.is_end():
+            break
+
+    return ranges
+
+def _get_ranges(buf, state, tag):
+    # The recorded ranges are only kept up to date by full grep runs, after
+    # any other change they are found again from the buffer
+    if state.ranges_version != state.version:
+        state.ranges = {}
+        state.ranges_version = state.version
+
+    ranges = state.ranges.get(tag)
+
+    if ranges is None:
+        ranges = _find_ranges(buf, tag)
+        state.ranges[tag] = ranges
+
+    return ranges
+
+def _apply_tag(buf, tag, start, end):
+    buf.apply_tag(tag, start, end)
+
+    state = _get_state(buf)
+
+    if state.ranges_version == state.version and tag in state.ranges:
+        state.ranges[tag].add(start.get_offset(), end.get_offset())
+
+def _remove_tag(buf, tag, start, end):
+    state = _get_state(buf)
+
+    # Only touch the buffer where grep actually applied the tag
+    if state.ranges_version == state.version and tag in state.ranges:
+        if not state.ranges[tag].remove(start.get_offset(), end.get_offset()):
+            return
+
+    buf.remove_tag(tag, start, end)
+
+def _clear_tag(buf, state, tag):
+    ranges = _get_ranges(buf, state, tag)
+
+    for start, end in ranges:
+        buf.remove_tag(tag, buf.get_iter_at_offset(start), buf.get_iter_at_offset(end))
+
+    state.ranges[tag] = _Ranges()
+
+def _lookup_result(state, matcher):
+    result = state.results.pop(matcher, None)
+
+    if result is None or result.version != state.version:
+        return None
+
+    state.results[matcher] = result
+    return result
+
+def _store_result(state, result):
+    # Keep the results of the most recently used patterns, switching between
+    # them then only needs the lines to be tagged again
+    state.results.pop(result.matcher, None)
+
+    for matcher in state.results.keys():
+        if state.results[matcher].version != state.version:
+            del state.results[matcher]
+
+    if len(state.results) >= ResultCacheSize:
+        state.results.popitem(False)
+
+    state.results[result.matcher] = result
+
+def _on_buffer_changed(buf, state):
+    state.version += 1
+
+class _Syntax:
+    """The comments, strings or code (anything else) of a document, looked up
+    in the lexical index of the document (see _clex). base is the offset in
+    the document of the text being matched. There is one per document and
+    class, which keeps the matchers restricted to it."""
+
+    def __init__(self, cls):
+        self.cls = cls
+        self.index = None
+        self.base = 0
+        self.matchers = collections.OrderedDict()
+
+    def update(self, buf):
+        # Only the part of the document that changed is lexed again
+        self.index = _clex.get(buf)
+
+    def contains(self, s, e):
+        s += self.base
+        e += self.base
+
+        index = self.index
+        i = index.span_at(s)
+
+        if self.cls == 'code':
+            # Neither in a span nor reaching the next one
+            if i >= 0:
+                return False
+
+            j = index.starts.bisect_right(s)
+            return j >= len(index.starts) or e <= index.starts[j]
+
+        return i >= 0 and e <= index.ends[i] and index.has_class(s, self.cls)
+
+class _SyntaxMatcher:
+    # Only keeps the matches of another matcher that are within the ranges of
+    # a _Syntax
+    def __init__(self, matcher, syntax):
+        self.matcher = matcher
+        self.syntax = syntax
+        self.risky = matcher.risky
+        self.ahead = matcher.ahead
+
+    def spans(self, text, pos, endpos):
+        contains = self.syntax.contains
+
+        for s, e in self.matcher.spans(text, pos, endpos):
+            if contains(s, e):
+                yield (s, e)
+
+def _restrict(matcher, syntax):
+    # The restricted matcher is kept with the syntax, the same one is needed
+    # again to reuse results. Least recently used ones are dropped like
+    # compiled patterns.
+    restricted = syntax.matchers.pop(matcher, None)
+
+    if restricted is None:
+        if isinstance(matcher, _CompositeMatcher):
+            restricted = _CompositeMatcher([[(_SyntaxMatcher(m, syntax), negate) for m, negate in terms]
+                                            for terms in matcher.alternatives])
+        else:
+            restricted = _SyntaxMatcher(matcher, syntax)
+
+        if len(syntax.matchers) >= PatternCacheSize:
+            syntax.matchers.popitem(False)
+
+    syntax.matchers[matcher] = restricted
+    return restricted
+
+def _unicode(text):
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+
+    return text
+
+def _get_text(start, end):
+    return _unicode(start.get_text(end))
+
+def _line_starts(text):
+    starts = [0]
+    starts.extend([m.end(0) for m in _line_end_re.finditer(text)])
+
+    return starts
+
+def _line_at(starts, offset):
+    return bisect.bisect_right(starts, offset) - 1
+
+def _match_lines(matcher, text, starts, first=0, last=None):
+    """Match over the lines first up to last of text in a single pass,
+    returning a mask with a '1' for every line with a match (and '0'
+    otherwise), together with an array of the start and end offsets of all
+    non-empty matches. Every line is matched on its own, without its line
+    end, like when matching line by line."""
+    if last is None:
+        last = len(starts)
+
+    if isinstance(matcher, _CompositeMatcher):
+        return matcher.match_lines(text, starts, first, last)
+
+    if last < len(starts):
+        endpos = starts[last]
+    else:
+        endpos = len(text)
+
+    mask = bytearray('0' * (last - first))
+    spans = array.array('l')
+
+    if matcher.ahead:
+        # The line end would be visible past the end of a match, so every line
+        # is matched on its own
+        for line in xrange(first, last):
+            lo = starts[line]
+
+            if line + 1 < len(starts):
+                end = _line_end_re.search(text, lo, starts[line + 1]).start(0)
+            else:
+                end = len(text)
+
+            for s, e in matcher.spans(text, lo, end):
+                mask[line - first] = '1'
+
+                if e > s:
+                    spans.append(s)
+                    spans.append(e)
+
+        return mask, spans
+
+    # Bounds of the line of the previous match, most matches share a line:
+    # its start, the end of its text and the start of the next line
+    lo = end = hi = done = 0
+    line = -1
+
+    pos = starts[first]
+    restart = True
+
+    while restart:
+        restart = False
+
+        for s, e in matcher.spans(text, pos, endpos):
+            if not lo <= s < hi:
+                line = _line_at(starts, s)
+
+                if line >= last:
+                    # An empty match at endpos, on the line after the last
+                    break
+
+                lo = done = starts[line]
+
+                if line + 1 < len(starts):
+                    hi = starts[line + 1]
+                    end = _line_end_re.search(text, lo, hi).start(0)
+                else:
+                    hi = len(text) + 1
+                    end = len(text)
+
+            if e > end:
+                # Lines are matched on their own, without their line end, so
+                # the rest of a line with a match running past its end is
+                # matched again on its own
+                for s, e in matcher.spans(text, done, end):
+                    mask[line - first] = '1'
+
+                    if e > s:
+                        spans.append(s)
+                        spans.append(e)
+
+                pos = hi
+                restart = line + 1 < last
+                break
+
+            mask[line - first] = '1'
+            done = e
+
+            if e > s:
+                spans.append(s)
+                spans.append(e)
+
+    return mask, spans
+
+def _dilate(mask, before, after):
+    # Mark the lines up to before lines preceding and after lines following a
+    # matching line of mask as matching too, overlapping windows merge
+    n = len(mask)
+    ret = bytearray('0' * n)
+
+    for run in _ones_re.finditer(str(mask)):
+        s = max(0, run.start(0) - before)
+        e = min(n, run.end(0) + after)
+
+        ret[s:e] = '1' * (e - s)
+
+    return ret
+
+def _iter_at_line(buf, lines, line):
+    if line >= lines:
+        return buf.get_end_iter()
+
+    return buf.get_iter_at_line(line)
+
+def _apply_runs(buf, first, mask, end, match_action, non_match_action):
+    # mask covers the lines starting at line first, up to the iter end
+    mask = str(mask)
+
+    for run in _run_re.finditer(mask):
+        start = buf.get_iter_at_line(first + run.start(0))
+
+        if run.end(0) < len(mask):
+            stop = buf.get_iter_at_line(first + run.end(0))
+        else:
+            stop = end.copy()
+
+        if mask[run.start(0)] == '1':
+            match_action(buf, start, stop)
+        else:
+            non_match_action(buf, start, stop)
+
+def _highlight(buf, spans, offset=0):
+    # The spans are sorted, so a single iter is moved forward from one span to
+    # the next, instead of locating every offset from the start of its line
+    # again (which is quadratic in the length of the line). Overlapping and
+    # adjacent spans are highlighted at once.
+    n = len(spans)
+
+    if not n:
+        return
+
+    tag = _get_highlight_tag(buf)
+
+    start = buf.get_iter_at_offset(offset + spans[0])
+    pos = spans[0]
+
+    line = start.get_line()
+    count = 0
+
+    i = 0
+
+    while i < n:
+        s = spans[i]
+        e = spans[i + 1]
+        i += 2
+
+        while i < n and spans[i] <= e:
+            e = max(e, spans[i + 1])
+            i += 2
+
+        start.forward_chars(s - pos)
+        pos = s
+
+        if start.get_line() != line:
+            line = start.get_line()
+            count = 0
+
+        count += 1
+
+        if count > MaxHighlightsPerLine:
+            # Skip the remaining matches of this line
+            if not start.forward_line():
+                break
+
+            pos = start.get_offset() - offset
+
+            while i < n and spans[i] < pos:
+                i += 2
+
+            continue
+
+        end = start.copy()
+        end.forward_chars(e - s)
+
+        _apply_tag(buf, tag, start, end)
+
+        start = end
+        pos = e
+
+def _unhighlight(buf, start, end):
+    _remove_tag(buf, _get_highlight_tag(buf), start, end)
+
+def _match_syntax(buf, state, text, starts, offset=0):
+    # Match the active filter on text found at offset in the document
+    syntax = state.syntax
+
+    if syntax is None:
+        return _match_lines(state.matcher, text, starts)
+
+    syntax.update(buf)
+    syntax.base = offset
+
+    try:
+        return _match_lines(state.matcher, text, starts)
+    finally:
+        syntax.base = 0
+
+def _grep_region(buf, state, start, end):
+    # start must be at the start of a line, end at the start of a line or at
+    # the end of the buffer. The whole region is matched in one go, instead of
+    # fetching and matching every line separately. Returns the first line and
+    # the offset of what was matched, with the mask and spans of the matches.
+    before, after = state.context
+
+    if before or after:
+        # The context of the lines around the region can change as well, which
+        # depends on the matches around those lines
+        start = buf.get_iter_at_line(max(0, start.get_line() - before - after))
+        end = end.copy()
+
+        if not end.is_end():
+            end.forward_lines(before + after)
+
+    text = _get_text(start, end)
+    starts = _line_starts(text)
+
+    if not end.is_end():
+        # The last start is the line following the region
+        starts.pop()
+
+    mask, spans = _match_syntax(buf, state, text, starts, start.get_offset())
+    first = start.get_line()
+
+    _unhighlight(buf, start, end)
+
+    if before or after:
+        # Only the lines that have all of their context in the region are
+        # known for sure
+        ctx = _dilate(mask, before, after)
+
+        s = 0
+        e = len(ctx)
+
+        if first > 0:
+            s = min(after, e)
+
+        if not end.is_end():
+            e = max(s, e - before)
+            end = buf.get_iter_at_line(first + e)
+
+        _apply_runs(buf, first + s, ctx[s:e], end, state.match_action, state.non_match_action)
+    else:
+        _apply_runs(buf, first, mask, end, state.match_action, state.non_match_action)
+
+    _highlight(buf, spans, start.get_offset())
+    return first, start.get_offset(), mask, spans
+
+def _timeout_message(line):
+    return 'Matching took more than %g seconds on line %d, giving up' % (MatchTimeout, line + 1)
+
+def _init_worker(snapshot):
+    # Runs in a worker process when forked. The snapshot is inherited instead
+    # of being sent over, so the worker shares the memory of the text.
+    global _parallel_snapshot
+    _parallel_snapshot = snapshot
+
+def _parallel_match(chunk):
+    # Runs in a worker process, on the snapshot it inherited when forked
+    matcher, text, starts, progress = _parallel_snapshot
+    index, first, last = chunk
+
+    if progress is None:
+        mask, spans = _match_lines(matcher, text, starts, first, last)
+        return first, last, str(mask), spans
+
+    # Guarded matching goes line by line, publishing the line being matched so
+    # that the main process can tell which line got stuck
+    mask = bytearray()
+    spans = array.array('l')
+
+    for line in xrange(first, last):
+        progress[index] = line
+
+        m, sp = _match_lines(matcher, text, starts, line, line + 1)
+
+        mask.extend(m)
+        spans.extend(sp)
+
+    progress[index] = -1
+    return first, last, str(mask), spans
+
+class _Guard:
+    """A worker process matching a snapshot with a pattern that may backtrack
+    catastrophically. It is stopped when it spends more than MatchTimeout
+    seconds on a single line."""
+
+    def __init__(self, matcher, text, starts):
+        self.starts = starts
+        self.progress = multiprocessing.Array('l', [-2], lock=False)
+        self.pool = multiprocessing.Pool(1, _init_worker, ((matcher, text, starts, self.progress),))
+
+    def match_lines(self, first, last):
+        # Blocks until done, raises Execute when giving up
+        result = self.pool.apply_async(_parallel_match, [(0, first, last)])
+        seen = (self.progress[0], time.time())
+
+        while True:
+            try:
+                first, last, mask, spans = result.get(TimeSlice)
+                return bytearray(mask), spans
+            except multiprocessing.TimeoutError:
+                pass
+
+            line = self.progress[0]
+            now = time.time()
+
+            if line != seen[0]:
+                seen = (line, now)
+            elif line >= 0 and now - seen[1] > MatchTimeout:
+                self.close()
+                raise commands.exceptions.Execute(_timeout_message(line))
+
+    def close(self):
+        if self.pool:
+            self.pool.terminate()
+            self.pool = None
+
+def _guarded_match_lines(matcher, text, starts, first=0, last=None):
+    # Like _match_lines, but safe for patterns that may backtrack
+    # catastrophically
+    if not matcher.risky:
+        return _match_lines(matcher, text, starts, first, last)
+
+    if last is None:
+        last = len(starts)
+
+    guard = _Guard(matcher, text, starts)
+
+    try:
+        return guard.match_lines(first, last)
+    finally:
+        guard.close()
+
+def _get_vadjustment(view):
+    if hasattr(view, 'get_vadjustment'):
+        return view.get_vadjustment()
+
+    # Older views are scrolled by the adjustment of their scrolled window
+    return view.get_parent().get_vadjustment()
+
+class _GrepJob:
+    """Runs a grep over the whole document in chunks of lines from the main
+    loop, so that large documents do not block the UI. Every chunk is tagged as
+    soon as it has been matched; cancelling reverts the lines that were not
+    processed yet. When given a view, the lines visible in the view are
+    processed first, also after scrolling."""
+
+    def __init__(self, buf, state, entry=None, view=None):
+        self.buf = buf
+        self.state = state
+        self.entry = entry
+        self.view = view
+
+        self.suspend = None
+        self.idle_id = 0
+        self.scroll_id = 0
+        self.pool = None
+        self.error = None
+
+        if entry:
+            entry.connect('destroy', self._on_entry_destroy)
+
+        if view:
+            self.adjustment = _get_vadjustment(view)
+            self.scroll_id = self.adjustment.connect('value-changed', self._on_scroll)
+
+        state.job = self
+        self._snapshot()
+
+    def _snapshot(self):
+        buf = self.buf
+        state = self.state
+
+        self.version = state.version
+
+        # Re-applying a recent result to an unchanged document only needs the
+        # tags to be redone, which goes by the lines of the buffer without a
+        # copy of its text
+        self.replay = _lookup_result(state, state.matcher)
+        self.loading = None
+
+        if self.replay:
+            self.replay_mask = self.replay.mask()
+            self.text = None
+            self.starts = None
+            self.lines = buf.get_line_count()
+        elif self.view and not state.matcher.risky:
+            # The lines are fetched as they are matched, so that the visible
+            # ones do not wait for a copy of the document. Large documents are
+            # copied in time slices after those, to match the rest in parallel.
+            self.text = None
+            self.starts = None
+            self.lines = buf.get_line_count()
+
+            if buf.get_char_count() >= ParallelThreshold:
+                self.loading = ([], [0])
+        else:
+            self.text = _get_text(buf.get_start_iter(), buf.get_end_iter())
+            self.starts = _line_starts(self.text)
+            self.lines = len(self.starts)
+
+        # Ranges of lines still to be processed, in order of priority
+        self.pending = [(0, self.lines)]
+        self.remaining = self.lines
+
+        self.mask = bytearray('0' * self.lines)
+        self.spans = []
+
+        # The matching lines so far, context is computed from these
+        if self.replay:
+            self.raw = self.replay_mask
+        else:
+            self.raw = self.mask
+
+        # Make sure the records of tagged ranges are valid for this snapshot,
+        # so that removing tags only touches what is actually tagged
+        for tag in (_get_invisible_tag(buf), _get_zoomout_tag(buf)):
+            _get_ranges(buf, state, tag)
+
+        _clear_tag(buf, state, _get_highlight_tag(buf))
+
+        if state.syntax and not self.replay:
+            state.syntax.update(buf)
+
+        if self.view:
+            self._prioritize_visible()
+
+        self._stop_pool()
+
+        # Patterns that may backtrack catastrophically are always matched in
+        # worker processes, which can be stopped when they take too long
+        if self.text is not None and (len(self.text) >= ParallelThreshold or self.state.matcher.risky):
+            self._start_pool(self.state.matcher.risky)
+
+    def _start_pool(self, guard=False):
+        # Split the pending lines in chunks, in order of priority
+        chunks = []
+
+        for first, last in self.pending:
+            for i in xrange(first, last, ParallelChunkLines):
+                chunks.append((i, min(last, i + ParallelChunkLines)))
+
+        if guard:
+            # The line each chunk is at, -2 before it started and -1 when done
+            self.progress = multiprocessing.Array('l', [-2] * len(chunks), lock=False)
+            self.watch = {}
+        else:
+            self.progress = None
+
+        snapshot = (self.state.matcher, self.text, self.starts, self.progress)
+        processes = max(1, min(ParallelProcesses or multiprocessing.cpu_count(), len(chunks)))
+
+        self.pool = multiprocessing.Pool(processes, _init_worker, (snapshot,))
+
+        tasks = [(i, first, last) for i, (first, last) in enumerate(chunks)]
+
+        self.parallel = self.pool.imap(_parallel_match, tasks)
+        self.chunks = chunks
+        self.chunk = 0
+        self.pending = []
+
+    def _load(self, deadline):
+        # Copy the document in batches of lines until the deadline, returns
+        # whether it is complete
+        buf = self.buf
+        pieces, starts = self.loading
+
+        while True:
+            line = len(starts) - 1
+            start = buf.get_iter_at_line(line)
+            base = start.get_offset()
+
+            pieces.append(_get_text(start, _iter_at_line(buf, self.lines, line + ParallelChunkLines)))
+            starts.extend([base + s for s in _line_starts(pieces[-1])[1:]])
+
+            if line + ParallelChunkLines >= self.lines:
+                self.text = u''.join(pieces)
+                self.starts = starts
+                self.loading = None
+
+                return True
+
+            if time.time() >= deadline:
+                return False
+
+    def _stop_pool(self):
+        if self.pool:
+            self.pool.terminate()
+            self.pool = None
+            self.parallel = None
+
+    def _stale(self):
+        # Line numbers of the snapshot no longer apply after an edit
+        return self.version != self.state.version
+
+    def _visible_lines(self):
+        rect = self.view.get_visible_rect()
+
+        first = self.view.get_line_at_y(rect.y)[0].get_line()
+        last = self.view.get_line_at_y(rect.y + rect.height)[0].get_line() + 1
+
+        return max(0, first - ViewMargin), min(self.lines, last + ViewMargin)
+
+    def _is_visible(self, first, last):
+        vfirst, vlast = self._visible_lines()
+        return first < vlast and last > vfirst
+
+    def _prioritize_visible(self):
+        first, last = self._visible_lines()
+
+        front = []
+        back = []
+
+        for s, e in self.pending:
+            if s < last and e > first:
+                vs = max(s, first)
+                ve = min(e, last)
+
+                front.append((vs, ve))
+
+                if s < vs:
+                    back.append((s, vs))
+
+                if ve < e:
+                    back.append((ve, e))
+            else:
+                back.append((s, e))
+
+        self.pending = front + back
+
+    def _on_scroll(self, adjustment):
+        if not self._stale():
+            self._prioritize_visible()
+
+    def _on_entry_destroy(self, entry):
+        self.entry = None
+        self.cancel()
+
+    def _on_resume(self):
+        # Commander resumes a suspended command when it is cancelled by the
+        # user. When we resume it ourselves, the job is already done.
+        self.suspend = None
+        self.cancel()
+
+    def _process(self, first, last):
+        if self.replay:
+            mask = self.replay_mask[first:last]
+
+            offsets = self.replay.offsets()
+            i = bisect.bisect_left(offsets, self.buf.get_iter_at_line(first).get_offset())
+
+            if last < self.lines:
+                j = bisect.bisect_left(offsets, self.buf.get_iter_at_line(last).get_offset())
+            else:
+                j = len(offsets)
+
+            self._tag(first, last, mask, self.replay.spans[i * 2:j * 2])
+        elif self.text is None:
+            self._add(first, last, *self._match_fetched(first, last))
+        else:
+            mask, spans = _match_lines(self.state.matcher, self.text, self.starts, first, last)
+            self._add(first, last, mask, spans)
+
+    def _match_fetched(self, first, last):
+        # Match the lines first up to last fetched from the buffer, returns
+        # spans at their offsets in the document
+        syntax = self.state.syntax
+
+        start = self.buf.get_iter_at_line(first)
+        base = start.get_offset()
+        text = _get_text(start, _iter_at_line(self.buf, self.lines, last))
+
+        if syntax:
+            syntax.base = base
+
+        try:
+            mask, spans = _match_lines(self.state.matcher, text, _line_starts(text), 0, last - first)
+        finally:
+            if syntax:
+                syntax.base = 0
+
+        return mask, array.array('l', [base + s for s in spans])
+
+    def _add(self, first, last, mask, spans):
+        self.mask[first:last] = mask
+        self.spans.append((first, spans))
+
+        self._tag(first, last, mask, spans)
+
+    def _tag(self, first, last, mask, spans):
+        buf = self.buf
+        state = self.state
+
+        before, after = state.context
+
+        if before or after:
+            mask = self._context(first, last)
+
+        end = _iter_at_line(buf, self.lines, last)
+
+        _apply_runs(buf, first, mask, end, state.match_action, state.non_match_action)
+        _highlight(buf, spans)
+
+        self.remaining -= last - first
+
+    def _context(self, first, last):
+        # Dilate the matching lines around the chunk into its context window.
+        # Lines of neighbouring chunks can only gain context from the matches
+        # in this chunk, so those are just shown. Returns the mask of the
+        # chunk.
+        buf = self.buf
+        before, after = self.state.context
+
+        n = self.lines
+        lo = max(0, first - before)
+        hi = min(n, last + after)
+        wlo = max(0, lo - after)
+
+        ctx = _dilate(self.raw[wlo:min(n, hi + before)], before, after)
+        ctx = str(ctx[lo - wlo:hi - wlo])
+
+        for s, e in ((lo, first), (last, hi)):
+            for run in _ones_re.finditer(ctx, s - lo, e - lo):
+                self.state.match_action(buf,
+                                        _iter_at_line(buf, self.lines, lo + run.start(0)),
+                                        _iter_at_line(buf, self.lines, lo + run.end(0)))
+
+        return ctx[first - lo:last - lo]
+
+    def _step_parallel(self, deadline):
+        # Tag the chunks matched by the worker processes, in order, as far as
+        # they are available
+        while self.remaining:
+            try:
+                self._add(*self.parallel.next(0))
+            except multiprocessing.TimeoutError:
+                if self.progress is not None:
+                    self._check_progress()
+
+                return False
+
+            self.chunk += 1
+
+            if time.time() >= deadline:
+                return not self.remaining
+
+        return True
+
+    def _check_progress(self):
+        # Give up when a worker has been matching the same line for longer
+        # than MatchTimeout. Chunks are started in order, so the ones that
+        # did not start yet come after all the others.
+        now = time.time()
+
+        for i in xrange(self.chunk, len(self.chunks)):
+            line = self.progress[i]
+
+            if line == -2:
+                break
+
+            if line < 0:
+                continue
+
+            seen = self.watch.get(i)
+
+            if not seen or seen[0] != line:
+                self.watch[i] = (line, now)
+            elif now - seen[1] > MatchTimeout:
+                self.error = _timeout_message(line)
+                self.cancel()
+                return
+
+    def step(self):
+        deadline = time.time() + TimeSlice
+
+        while True:
+            if self._stale():
+                self._snapshot()
+
+            if self.pool:
+                return self._step_parallel(deadline)
+
+            if not self.pending:
+                return True
+
+            first, last = self.pending[0]
+
+            if self.loading and not self._is_visible(first, last):
+                # The rest is matched in parallel once the document is copied
+                if self._load(deadline):
+                    self._start_pool()
+                    continue
+
+                return False
+
+            stop = min(last, first + ChunkLines)
+
+            if stop < last:
+                self.pending[0] = (stop, last)
+            else:
+                del self.pending[0]
+
+            self._process(first, stop)
+
+            if not self.pending:
+                return True
+
+            if time.time() >= deadline:
+                return False
+
+    def _on_idle(self):
+        if not self.step():
+            if self.error:
+                return False
+
+            if self.entry:
+                total = self.lines
+                self.entry.info_status('Grep: %d of %d lines' % (total - self.remaining, total))
+
+            return True
+
+        self.idle_id = 0
+        self._done()
+
+        return False
+
+    def _done(self):
+        result = self.replay
+
+        if not result:
+            spans = array.array('l')
+
+            for first, sp in sorted(self.spans, key=lambda x: x[0]):
+                spans.extend(sp)
+
+            result = _GrepResult(self.state.matcher, self.version, self.mask, spans)
+            _store_result(self.state, result)
+
+        if self.state.follow:
+            self.state.follow.reset(self.buf, result)
+
+        self._finish()
+
+    def _finish(self):
+        self.state.job = None
+        self._stop_pool()
+
+        if self.scroll_id:
+            self.adjustment.disconnect(self.scroll_id)
+            self.scroll_id = 0
+
+        if self.suspend:
+            suspend = self.suspend
+            self.suspend = None
+
+            suspend.resume()
+
+    def start(self, wait=True):
+        """Process the first time slice right away. Returns None when that was
+        enough or when not waiting for the rest, or a Suspend result to yield
+        from the command otherwise"""
+        if self.step():
+            self._done()
+            return None
+
+        self.idle_id = glib.idle_add(self._on_idle)
+
+        if not wait:
+            return None
+
+        self.suspend = commands.result.Suspend()
+        self.suspend.register(self._on_resume)
+
+        return self.suspend
+
+    def cancel(self):
+        if not self.idle_id:
+            return
+
+        glib.source_remove(self.idle_id)
+        self.idle_id = 0
+
+        # Leave the lines that were not processed yet untouched by grep, so the
+        # document is never left with a mix of the old and the new filter
+        buf = self.buf
+
+        if self._stale():
+            pending = [(buf.get_start_iter(), buf.get_end_iter())]
+        else:
+            if self.pool:
+                lines = self.chunks[self.chunk:]
+            else:
+                lines = self.pending
+
+            pending = [(_iter_at_line(buf, self.lines, first), _iter_at_line(buf, self.lines, last))
+                       for first, last in lines]
+
+        for start, end in pending:
+            _remove_tag(buf, _get_highlight_tag(buf), start, end)
+            _remove_tag(buf, _get_invisible_tag(buf), start, end)
+            _remove_tag(buf, _get_zoomout_tag(buf), start, end)
+
+        self._finish()
+
+def _on_live_idle(buf, state):
+    state.idle_id = 0
+
+    if state.dirty is None or state.matcher is None:
+        return False
+
+    start = buf.get_iter_at_mark(state.dirty[0])
+    end = buf.get_iter_at_mark(state.dirty[1])
+
+    buf.delete_mark(state.dirty[0])
+    buf.delete_mark(state.dirty[1])
+    state.dirty = None
+
+    if state.job:
+        # A running grep restarts on edits and will retag everything anyway
+        return False
+
+    # Extend to full lines, the line containing end was edited as well
+    start.set_line_offset(0)
+    end.forward_line()
+
+    _grep_region(buf, state, start, end)
+    return False
+
+def _mark_dirty(buf, state, start, end):
+    if state.dirty is None:
+        state.dirty = [buf.create_mark(None, start, True),
+                       buf.create_mark(None, end, False)]
+    else:
+        if start.compare(buf.get_iter_at_mark(state.dirty[0])) < 0:
+            buf.move_mark(state.dirty[0], start)
+
+        if end.compare(buf.get_iter_at_mark(state.dirty[1])) > 0:
+            buf.move_mark(state.dirty[1], end)
+
+    # Retag from idle, other handlers still need the iters of this edit
+    if not state.idle_id:
+        state.idle_id = glib.idle_add(_on_live_idle, buf, state)
+
+def _on_insert_text(buf, piter, text, length, state):
+    start = piter.copy()
+    start.backward_chars(len(_unicode(text)))
+
+    _mark_dirty(buf, state, start, piter)
+
+def _on_delete_range(buf, start, end, state):
+    _mark_dirty(buf, state, start, end)
+
+def _live_start(buf, state):
+    state.handlers = [buf.connect_after('insert-text', _on_insert_text, state),
+                      buf.connect_after('delete-range', _on_delete_range, state)]
+
+def _live_stop(buf, state):
+    for handler in state.handlers:
+        buf.disconnect(handler)
+
+    state.handlers = []
+
+    if state.idle_id:
+        glib.source_remove(state.idle_id)
+        state.idle_id = 0
+
+    if state.dirty:
+        buf.delete_mark(state.dirty[0])
+        buf.delete_mark(state.dirty[1])
+        state.dirty = None
+
+class _Follow:
+    """What follow mode knows about a document: the complete lines before
+    offset were matched and tagged, mask and spans are their result. Only
+    valid while the text before offset is unchanged."""
+
+    def __init__(self):
+        self.valid = False
+        self.offset = 0
+        self.lines = 0
+        self.mask = bytearray()
+        self.spans = array.array('l')
+        self.fingerprint = None
+
+        # Set when the document was emptied, which is how it gets reloaded
+        self.reloading = False
+        self.length = -1
+
+        self.handlers = []
+        self.idle_id = 0
+
+    def reset(self, buf, result):
+        # Take over a result for the whole document, the last line may still
+        # be growing
+        last = max(0, result.lines - 1)
+
+        self.offset = buf.get_iter_at_line(last).get_offset()
+        self.lines = last
+        self.mask = bytearray(result.mask()[:last])
+
+        i = bisect.bisect_left(result.offsets(), self.offset)
+        self.spans = result.spans[:i * 2]
+
+        self.fingerprint = _fingerprint(buf, self.offset)
+        self.reloading = False
+        self.valid = True
+
+def _fingerprint(buf, offset):
+    # Samples of the text before offset, to recognize a reloaded document of
+    # which only the end changed
+    if buf.get_char_count() < offset:
+        return None
+
+    head = _get_text(buf.get_start_iter(), buf.get_iter_at_offset(min(offset, FollowSample)))
+    tail = _get_text(buf.get_iter_at_offset(max(0, offset - FollowSample)), buf.get_iter_at_offset(offset))
+
+    return (offset, hash(head), hash(tail))
+
+def _follow_tail(buf, state):
+    # Match and tag from the first line that was not complete yet
+    f = state.follow
+
+    first, offset, mask, spans = _grep_region(buf, state, buf.get_iter_at_offset(f.offset), buf.get_end_iter())
+
+    end = buf.get_end_iter()
+    end.set_line_offset(0)
+
+    lines = end.get_line() - f.lines
+
+    f.mask.extend(mask[f.lines - first:end.get_line() - first])
+
+    for i in xrange(0, len(spans), 2):
+        if f.offset <= spans[i] + offset < end.get_offset():
+            f.spans.append(spans[i] + offset)
+            f.spans.append(spans[i + 1] + offset)
+
+    f.lines += lines
+    f.offset = end.get_offset()
+    f.fingerprint = _fingerprint(buf, f.offset)
+
+def _follow_reloaded(buf, state):
+    # The text before the offset did not change, so its tags are redone from
+    # what follow mode knows, without fetching or matching that text again.
+    # Only the new tail is matched.
+    f = state.follow
+    before, after = state.context
+
+    mask = f.mask
+
+    if before or after:
+        # The context of the last lines is redone with the tail
+        mask = _dilate(mask, before, after)
+
+    _apply_runs(buf, 0, mask, buf.get_iter_at_offset(f.offset), state.match_action, state.non_match_action)
+    _highlight(buf, f.spans)
+
+    _follow_tail(buf, state)
+
+def _on_follow_idle(buf, state):
+    f = state.follow
+    f.idle_id = 0
+
+    if state.job or state.matcher is None:
+        # A running grep resets follow mode when done
+        return False
+
+    if f.reloading and f.valid:
+        length = buf.get_char_count()
+
+        if length == 0:
+            # Wait for the new text to be inserted
+            return False
+
+        if length != f.length:
+            # Probably still loading, check again once it stops growing
+            f.length = length
+            f.idle_id = glib.timeout_add(FollowReloadDelay, _on_follow_idle, buf, state)
+
+            return False
+
+        f.reloading = False
+        f.length = -1
+
+        if _fingerprint(buf, f.offset) == f.fingerprint:
+            _follow_reloaded(buf, state)
+            return False
+
+        f.valid = False
+
+    if f.valid:
+        _follow_tail(buf, state)
+    else:
+        _GrepJob(buf, state).start(False)
+
+    return False
+
+def _follow_schedule(buf, state):
+    if not state.follow.idle_id:
+        state.follow.idle_id = glib.idle_add(_on_follow_idle, buf, state)
+
+def _on_follow_insert_text(buf, piter, text, length, state):
+    f = state.follow
+
+    if not f.reloading and piter.get_offset() - len(_unicode(text)) < f.offset:
+        f.valid = False
+
+    _follow_schedule(buf, state)
+
+def _on_follow_delete_range(buf, start, end, state):
+    f = state.follow
+
+    if buf.get_char_count() == 0:
+        f.reloading = True
+    elif start.get_offset() < f.offset:
+        f.valid = False
+
+    _follow_schedule(buf, state)
+
+def _follow_start(buf, state):
+    f = _Follow()
+    state.follow = f
+
+    f.handlers = [buf.connect_after('insert-text', _on_follow_insert_text, state),
+                  buf.connect_after('delete-range', _on_follow_delete_range, state)]
+
+    result = _lookup_result(state, state.matcher)
+
+    if result and not state.job:
+        f.reset(buf, result)
+    elif not state.job:
+        _GrepJob(buf, state).start(False)
+
+def _follow_stop(buf, state):
+    f = state.follow
+
+    if f is None:
+        return
+
+    for handler in f.handlers:
+        buf.disconnect(handler)
+
+    if f.idle_id:
+        glib.source_remove(f.idle_id)
+
+    state.follow = None
+
+def _check_modes(state, matcher):
+    # Live and follow mode match edits within gedit, where matching cannot be
+    # stopped when it takes too long
+    if matcher.risky and (state.handlers or state.follow):
+        raise commands.exceptions.Execute('Live and follow mode need --linear for this regular expression')
+
+def _set_filter(buf, matcher, match_action, non_match_action, context=(0, 0), syntax=None):
+    # Remember the filter, live mode keeps applying it to edited lines
+    state = _get_state(buf)
+    _check_modes(state, matcher)
+
+    if state.job:
+        state.job.cancel()
+
+    state.matcher = matcher
+    state.match_action = match_action
+    state.non_match_action = non_match_action
+    state.context = context
+    state.syntax = syntax
+
+    if state.follow:
+        # What follow mode knows is about the previous filter
+        state.follow.valid = False
+
+    return state
+
+def _parse_context(options):
+    # -C sets the lines of context on both sides, -A and -B override it
+    try:
+        both = int(options.get('-C', 0))
+        before = int(options.get('-B', both))
+        after = int(options.get('-A', both))
+    except ValueError:
+        raise commands.exceptions.Execute('Invalid number of context lines')
+
+    if before < 0 or after < 0:
+        raise commands.exceptions.Execute('Invalid number of context lines')
+
+    return before, after
+
+def _parse_options(argstr, allowed):
+    # Split leading options from the argument. allowed maps the names of the
+    # options to whether they take a value. Parsing stops at the first word
+    # that is not an option, or after --.
+    options = {}
+    pos = 0
+
+    while True:
+        m = _option_re.match(argstr, pos)
+
+        if not m:
+            break
+
+        name = m.group(1)
+
+        if name == '--':
+            pos = m.end(0)
+            break
+
+        if not name in allowed:
+            break
+
+        pos = m.end(0)
+
+        if allowed[name]:
+            value = _value_re.match(argstr, pos)
+
+            if not value:
+                raise commands.exceptions.Execute('Missing value for option ' + name)
+
+            options[name] = value.group(1)
+            pos = value.end(0)
+        else:
+            options[name] = True
+
+    return options, argstr[pos:]
+
+def _parse_syntax(state, options):
+    classes = [cls for name, cls in _syntax_options.items() if name in options]
+
+    if not classes:
+        return None
+
+    if len(classes) > 1:
+        raise commands.exceptions.Execute('Use only one of --comments, --strings and --code')
+
+    # Kept per document, so that the ranges are only found again after edits
+    if not classes[0] in state.syntaxes:
+        state.syntaxes[classes[0]] = _Syntax(classes[0])
+
+    return state.syntaxes[classes[0]]
+
+def _grep(view, entry, argstr, match_action, non_match_action):
+    buf = view.get_buffer()
+    options, regex = _parse_options(argstr, _grep_options)
+
+    matcher = _compile(regex, '--linear' in options)
+    syntax = _parse_syntax(_get_state(buf), options)
+
+    if syntax:
+        matcher = _restrict(matcher, syntax)
+
+    state = _set_filter(buf, matcher, match_action, non_match_action, _parse_context(options), syntax)
+
+    if '--view' in options and not matcher.risky:
+        # Handle the visible part first and the rest in the background. Risky
+        # patterns are waited for, to be able to report giving up on them.
+        _GrepJob(buf, state, None, view).start(False)
+        return
+
+    job = _GrepJob(buf, state, entry)
+    suspend = job.start()
+
+    if suspend:
+        yield suspend
+
+    if job.error:
+        raise commands.exceptions.Execute(job.error)
+
+def _get_result(buf, state, matcher):
+    # A recent result is reused when it is still valid, otherwise the document
+    # is matched again (without tagging anything)
+    result = _lookup_result(state, matcher)
+
+    if result:
+        return result
+
+    if state.syntax and matcher is state.matcher:
+        state.syntax.update(buf)
+
+    text = _get_text(buf.get_start_iter(), buf.get_end_iter())
+    mask, spans = _guarded_match_lines(matcher, text, _line_starts(text))
+
+    result = _GrepResult(matcher, state.version, mask, spans)
+    _store_result(state, result)
+
+    return result
+
+def _select_match(view, result, i):
+    buf = view.get_buffer()
+    spans = result.spans
+
+    buf.select_range(buf.get_iter_at_offset(spans[i * 2]),
+                     buf.get_iter_at_offset(spans[i * 2 + 1]))
+
+    view.scroll_to_mark(buf.get_insert(), 0.25, False, 0.0, 0.0)
+
+def _goto_match(view, forward):
+    buf = view.get_buffer()
+    state = _get_state(buf)
+
+    if state.matcher is None:
+        raise commands.exceptions.Execute('No active grep command, run grep first')
+
+    result = _get_result(buf, state, state.matcher)
+    offsets = result.offsets()
+
+    if not offsets:
+        raise commands.exceptions.Execute('No matches')
+
+    bounds = buf.get_selection_bounds()
+
+    if not bounds:
+        piter = buf.get_iter_at_mark(buf.get_insert())
+        bounds = [piter, piter]
+
+    if forward:
+        i = bisect.bisect_left(offsets, bounds[1].get_offset())
+
+        if i == len(offsets):
+            i = 0
+    else:
+        i = bisect.bisect_left(offsets, bounds[0].get_offset()) - 1
+
+    _select_match(view, result, i)
+
+def _grep_all_worker(queue, doc, version, matcher, text, guard):
+    try:
+        if guard:
+            try:
+                mask, spans = guard.match_lines(0, len(guard.starts))
+            finally:
+                guard.close()
+        else:
+            mask, spans = _match_lines(matcher, text, _line_starts(text))
+
+        queue.put((doc, _GrepResult(matcher, version, mask, spans), None))
+    except commands.exceptions.Execute, e:
+        queue.put((doc, None, str(e)))
+    except:
+        queue.put((doc, None, None))
+        raise
+
+class _GrepAll:
+    """Matches snapshots of several documents on a pool of worker threads. The
+    results are collected on the main thread, where each document is tagged by
+    replaying its result in a regular grep job."""
+
+    def __init__(self, docs, entry, matcher, match_action, non_match_action):
+        self.entry = entry
+        self.queue = Queue.Queue()
+        self.pending = len(docs)
+        self.summary = []
+        self.jobs = []
+
+        for doc in docs:
+            _check_modes(_get_state(doc), matcher)
+
+        self.pool = multiprocessing.pool.ThreadPool(min(Workers, len(docs)))
+
+        # Snapshots have to be taken on the main thread, the first document is
+        # submitted (and thus matched and tagged) first. Guards are started
+        # here too, processes must not be forked from the worker threads.
+        for doc in docs:
+            state = _set_filter(doc, matcher, match_action, non_match_action)
+            text = _get_text(doc.get_start_iter(), doc.get_end_iter())
+            guard = None
+
+            if matcher.risky:
+                guard = _Guard(matcher, text, _line_starts(text))
+
+            self.pool.apply_async(_grep_all_worker, (self.queue, doc, state.version, matcher, text, guard))
+
+        self.pool.close()
+
+        self.timeout_id = glib.timeout_add(20, self._on_timeout)
+
+        self.suspend = commands.result.Suspend()
+        self.suspend.register(self._on_resume)
+
+    def _on_timeout(self):
+        while self.pending:
+            try:
+                doc, result, error = self.queue.get_nowait()
+            except Queue.Empty:
+                return True
+
+            self.pending -= 1
+            name = doc.get_short_name_for_display()
+
+            if error:
+                self.summary.append('%s: %s' % (name, error))
+
+            if result is None:
+                continue
+
+            state = _get_state(doc)
+
+            if state.matcher is not result.matcher:
+                # Another grep was started on the document since
+                continue
+
+            if state.job:
+                state.job.cancel()
+
+            _store_result(state, result)
+
+            # The job replays the result, or matches again if the document
+            # changed in the meantime
+            job = _GrepJob(doc, state)
+            job.start(False)
+
+            self.jobs.append((name, job))
+            self.summary.append('%s: %d lines, %d matches' % (name,
+                                                              result.matching_lines(),
+                                                              len(result.spans) / 2))
+
+        # Matching again can fail as well
+        if True in [job.idle_id != 0 for name, job in self.jobs]:
+            return True
+
+        for name, job in self.jobs:
+            if job.error:
+                self.summary.append('%s: %s' % (name, job.error))
+
+        self.timeout_id = 0
+        self.entry.info_show('\n'.join(self.summary))
+
+        suspend = self.suspend
+        self.suspend = None
+
+        suspend.resume()
+        return False
+
+    def _on_resume(self):
+        # Resumed by commander when cancelled by the user
+        if self.timeout_id:
+            glib.source_remove(self.timeout_id)
+            self.timeout_id = 0
+
+            self.pool.terminate()
+
+class _Extract:
+    """Copies the lines of a snapshot of a document that match into another
+    document, from the main loop in batches of ChunkLines lines. A recent
+    result for the pattern is reused instead of matching again."""
+
+    def __init__(self, buf, matcher, target, entry, numbers):
+        self.state = _get_state(buf)
+        self.matcher = matcher
+        self.target = target
+        self.entry = entry
+        self.numbers = numbers
+
+        self.version = self.state.version
+        self.text = _get_text(buf.get_start_iter(), buf.get_end_iter())
+        self.starts = _line_starts(self.text)
+
+        self.replay = _lookup_result(self.state, matcher)
+
+        self.guard = None
+        self.error = None
+
+        if self.replay:
+            self.replay_mask = self.replay.mask()
+        else:
+            self.mask = bytearray()
+            self.spans = array.array('l')
+
+            if matcher.risky:
+                self.guard = _Guard(matcher, self.text, self.starts)
+
+        self.line = 0
+        self.extracted = 0
+
+        self.idle_id = glib.idle_add(self._on_idle)
+
+        self.suspend = commands.result.Suspend()
+        self.suspend.register(self._on_resume)
+
+    def _line_end(self, line):
+        if line + 1 < len(self.starts):
+            return self.starts[line + 1]
+
+        return len(self.text)
+
+    def _extract(self, first, last):
+        if self.replay:
+            mask = self.replay_mask[first:last]
+        else:
+            if self.guard:
+                mask, spans = self.guard.match_lines(first, last)
+            else:
+                mask, spans = _match_lines(self.matcher, self.text, self.starts, first, last)
+
+            self.mask.extend(mask)
+            self.spans.extend(spans)
+
+        text = self.text
+        starts = self.starts
+        parts = []
+
+        for run in _ones_re.finditer(str(mask)):
+            s = first + run.start(0)
+            e = first + run.end(0)
+
+            if self.numbers:
+                for line in xrange(s, e):
+                    parts.append(u'%d:%s' % (line + 1, text[starts[line]:self._line_end(line)]))
+            else:
+                parts.append(text[starts[s]:self._line_end(e - 1)])
+
+            self.extracted += e - s
+
+        if not parts:
+            return
+
+        if last == len(starts) and not _line_end_re.match(parts[-1][-1:]):
+            parts.append(u'\n')
+
+        # Only the text of this batch is joined, the extracted lines are never
+        # built up as a whole
+        target = self.target
+
+        target.begin_not_undoable_action()
+        target.insert(target.get_end_iter(), u''.join(parts))
+        target.end_not_undoable_action()
+
+    def _on_idle(self):
+        deadline = time.time() + TimeSlice
+        total = len(self.starts)
+
+        while self.line < total:
+            last = min(total, self.line + ChunkLines)
+
+            try:
+                self._extract(self.line, last)
+            except commands.exceptions.Execute, e:
+                self.error = str(e)
+                self.idle_id = 0
+                self._finish()
+
+                return False
+
+            self.line = last
+
+            if time.time() >= deadline:
+                break
+
+        if self.line < total:
+            self.entry.info_status('Extract: %d of %d lines' % (self.line, total))
+            return True
+
+        self.idle_id = 0
+
+        if not self.replay and self.state.version == self.version:
+            _store_result(self.state, _GrepResult(self.matcher, self.version, self.mask, self.spans))
+
+        self._finish()
+        return False
+
+    def _finish(self):
+        if self.guard:
+            self.guard.close()
+
+        if not self.error:
+            self.entry.info_show('Extracted %d lines' % (self.extracted,))
+
+        suspend = self.suspend
+        self.suspend = None
+
+        suspend.resume()
+
+    def _on_resume(self):
+        # Resumed by commander when cancelled by the user, the lines extracted
+        # so far are kept
+        if self.idle_id:
+            glib.source_remove(self.idle_id)
+            self.idle_id = 0
+
+        if self.guard:
+            self.guard.close()
+
+def _create_file_matcher(regex):
+    # Files are matched on their raw bytes, which are taken to be UTF-8
+    words = _parse_literals(regex)
+
+    if words and len(words) == 1:
+        return _LiteralMatcher(words[0].encode('utf-8'))
+
+    if words and max([len(x) for x in words]) < 256:
+        regex = _trie_regex(set(words))
+
+    try:
+        return _RegexMatcher(re.compile(regex.encode('utf-8'), re.M))
+    except Exception, e:
+        raise commands.exceptions.Execute('Invalid regular expression: ' + str(e))
+
+def _walk_files(directory):
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+
+        for name in sorted(files):
+            yield os.path.join(root, name)
+
+def _scan_file(search, path):
+    # Runs on a worker thread. Matching lines are put on the queue in batches
+    # of (path, [(line, text)]), followed by (path, None) when done or
+    # (path, False) when the file was skipped.
+    queue = search.queue
+
+    try:
+        f = open(path, 'rb')
+    except (IOError, OSError):
+        queue.put((path, False))
+        return
+
+    try:
+        size = os.fstat(f.fileno()).st_size
+
+        if size == 0:
+            queue.put((path, None))
+            return
+
+        if size > FilesMaxSize:
+            queue.put((path, False))
+            return
+
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError):
+        queue.put((path, False))
+        return
+    finally:
+        f.close()
+
+    try:
+        if '\0' in m[:FilesBinarySample]:
+            queue.put((path, False))
+            return
+
+        batch = []
+        line = 1
+        pos = 0
+
+        while pos < size:
+            # The module has a command named next
+            for span in search.matcher.spans(m, pos, size):
+                break
+            else:
+                break
+
+            # pos is at the start of a line, never look back past it
+            start = max(pos, m.rfind('\n', pos, span[0]) + 1)
+            line += m[pos:start].count('\n')
+
+            end = m.find('\n', span[0])
+
+            if end < 0:
+                end = size
+
+            batch.append((line, m[start:end].rstrip('\r').decode('utf-8', 'replace')))
+
+            # Only the first match on a line is reported, the search goes on
+            # from the next line
+            line += 1
+            pos = end + 1
+
+            if len(batch) >= ChunkLines:
+                if search.cancelled:
+                    break
+
+                queue.put((path, batch))
+                batch = []
+
+        if batch:
+            queue.put((path, batch))
+
+        queue.put((path, None))
+    finally:
+        m.close()
+
+class _FileSearch:
+    """Scans the files in a directory on a pool of worker threads, mapping
+    every file in memory instead of reading it. Matching lines are collected
+    on the main thread and appended to a results document as they arrive."""
+
+    def __init__(self, directory, matcher, target, entry):
+        self.directory = directory
+        self.matcher = matcher
+        self.target = target
+        self.entry = entry
+
+        self.queue = Queue.Queue()
+        self.cancelled = False
+
+        self.scanned = 0
+        self.skipped = 0
+        self.lines = 0
+        self.done = False
+
+        self.pool = multiprocessing.pool.ThreadPool(Workers)
+
+        # The directory is walked while scanning, by the thread of the pool
+        # that hands out the tasks
+        self.result = self.pool.imap_unordered(lambda path: _scan_file(self, path),
+                                               _walk_files(directory))
+        self.pool.close()
+
+        self.timeout_id = glib.timeout_add(20, self._on_timeout)
+
+        self.suspend = commands.result.Suspend()
+        self.suspend.register(self._on_resume)
+
+    def _append(self, parts):
+        target = self.target
+
+        target.begin_not_undoable_action()
+        target.insert(target.get_end_iter(), u''.join(parts))
+        target.end_not_undoable_action()
+
+    def _finished(self):
+        # The tasks only finish after putting everything on the queue
+        while not self.done:
+            try:
+                self.result.next(0)
+            except StopIteration:
+                self.done = True
+            except multiprocessing.TimeoutError:
+                return False
+
+        return self.queue.empty()
+
+    def _on_timeout(self):
+        parts = []
+        deadline = time.time() + TimeSlice
+
+        while time.time() < deadline:
+            try:
+                path, batch = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+
+            if batch is False:
+                self.skipped += 1
+                continue
+
+            if batch is None:
+                self.scanned += 1
+                continue
+
+            name = os.path.relpath(path, self.directory).decode('utf-8', 'replace')
+
+            for line, text in batch:
+                parts.append(u'%s:%d: %s\n' % (name, line, text))
+
+            self.lines += len(batch)
+
+        if parts:
+            self._append(parts)
+
+        if not self._finished():
+            self.entry.info_status('Files: %d scanned, %d matching lines' % (self.scanned, self.lines))
+            return True
+
+        self.timeout_id = 0
+        self.entry.info_show('%d matching lines, %d files scanned, %d skipped' % (self.lines,
+                                                                                  self.scanned,
+                                                                                  self.skipped))
+
+        suspend = self.suspend
+        self.suspend = None
+
+        suspend.resume()
+        return False
+
+    def _on_resume(self):
+        # Resumed by commander when cancelled by the user
+        if self.timeout_id:
+            glib.source_remove(self.timeout_id)
+            self.timeout_id = 0
+
+            self.cancelled = True
+            self.pool.terminate()
+
+def _location(path):
+    if hasattr(gio.File, 'new_for_path'):
+        return gio.File.new_for_path(path)
+
+    return gio.File(path)
+
+def _open_file(window, path, line):
+    location = _location(path)
+
+    if hasattr(window, 'get_tab_from_location'):
+        tab = window.get_tab_from_location(location)
+    else:
+        tab = window.get_tab_from_uri(location.get_uri())
+
+    if tab is None:
+        if hasattr(window, 'create_tab_from_location'):
+            window.create_tab_from_location(location, None, line, 0, False, True)
+        else:
+            window.create_tab_from_uri(location.get_uri(), None, line, False, True)
+
+        return
+
+    window.set_active_tab(tab)
+
+    tab.get_document().goto_line(line - 1)
+    tab.get_view().scroll_to_cursor()
+
+def _open_result(window, buf, line):
+    # Opens the file of a result in a grep.files document at its line, returns
+    # False when there is no result on the line
+    directory = getattr(buf, FilesStateName, None)
+
+    if directory is None:
+        return False
+
+    start = buf.get_iter_at_line(line)
+    end = start.copy()
+
+    if not end.ends_line():
+        end.forward_to_line_end()
+
+    m = _result_re.match(_get_text(start, end))
+
+    if not m:
+        return False
+
+    _open_file(window, os.path.join(directory, m.group(1).encode('utf-8')), int(m.group(2)))
+    return True
+
+def _on_results_activate(view, window):
+    buf = view.get_buffer()
+
+    _open_result(window, buf, buf.get_iter_at_mark(buf.get_insert()).get_line())
+    return False
+
+def _on_results_button_press(view, event, window):
+    if event.type.value_nick == '2button-press':
+        # The view still has to move the cursor to where was clicked
+        glib.idle_add(_on_results_activate, view, window)
+
+    return False
+
+def __default__(view, entry, argstr):
+    """Hide non-matching lines in document: grep &lt;regex&gt;
+
+Matches a regular expression on each line and hides all text that does not
+match. For the revere (hiding matches) use grep.hide
+
+Regular expressions can be combined with &amp; (and), | (or) and ! (not),
+surrounded by spaces, for example: grep A &amp; !B | C. A single ! term such as
+grep !B shows the lines that do not match B, use \! for a literal ! at the
+start of a regex.
+
+Options (also for grep.hide, grep.zoomin and grep.zoomout):
+  --view      handle the visible lines first and the rest in the background
+  --linear    match in linear time, safe for any input but slower, and
+              without back references and look around assertions
+  -A &lt;n&gt;      also show n lines of context after matching lines
+  -B &lt;n&gt;      also show n lines of context before matching lines
+  -C &lt;n&gt;      also show n lines of context around matching lines
+  --comments  only match inside comments
+  --strings   only match inside strings
+  --code      only match outside comments and strings
+
+Regular expressions that may backtrack catastrophically, such as (a+)+b, are
+given at most a few seconds per line, after which grep gives up. The same goes
+for the other grep commands, except for live and follow mode which need
+--linear for such expressions. --view waits for them to finish."""
+    yield _grep(view, entry, argstr, _grep_action_show, _grep_action_hide)
+
+def hide(view, entry, argstr):
+    """Hide matching lines in document: grep.hide &lt;regex&gt;
+
+Matches a regular expression on each line and hides all matches. For
+the reverse (hiding lines that do not match) use grep.show"""
+    yield _grep(view, entry, argstr, _grep_action_hide, _grep_action_show)
+
+def zoomin(view, entry, argstr):
+    """Zoom in on matching lines in document: grep.zoomin &lt;regex&gt;
+
+Matches a regular expression on each line and magnifies all matching lines
+with respect to the non-matching lines. For the reverse, use grep.zoomout"""
+    yield _grep(view, entry, argstr, _grep_action_zoomin, _grep_action_zoomout)
+
+def zoomout(view, entry, argstr):
+    """Zoom out on matching lines in document: grep.zoomout &lt;regex&gt;
+
+Matches a regular expression on each line and minifies all matching lines
+with respect to the non-matching lines. For the reverse, use grep.zoomin"""
+    yield _grep(view, entry, argstr, _grep_action_zoomout, _grep_action_zoomin)
+
+def all_documents(view, window, entry, argstr):
+    """Hide non-matching lines in all documents: grep.all &lt;regex&gt;
+
+Matches a regular expression on each line of every document in the window and
+hides all text that does not match. The active document is handled first. The
+number of matching lines and matches are shown for every document.
+
+grep.all only shows and hides lines, there is no variant that zooms.
+
+Options:
+  --linear  match in linear time, see grep"""
+    docs = window.get_documents()
+    active = window.get_active_document()
+
+    if active in docs:
+        docs.remove(active)
+        docs.insert(0, active)
+
+    if not docs:
+        return
+
+    options, regex = _parse_options(argstr, _all_options)
+    matcher = _compile(regex, '--linear' in options)
+
+    yield _GrepAll(docs, entry, matcher, _grep_action_show, _grep_action_hide).suspend
+
+def next_match(view):
+    """Go to the next match: grep.next
+
+Selects the next match of the active grep command after the cursor."""
+    _goto_match(view, True)
+
+def previous_match(view):
+    """Go to the previous match: grep.prev
+
+Selects the previous match of the active grep command before the cursor."""
+    _goto_match(view, False)
+
+def count(view, entry, argstr):
+    """Count matches in document: grep.count [--linear] [&lt;regex&gt;]
+
+Counts the matches of a regular expression and the number of lines they are
+on, without changing the document. Without a regex, the matches of the active
+grep command are counted.
+
+Options:
+  --linear  match in linear time, see grep"""
+    buf = view.get_buffer()
+    state = _get_state(buf)
+    options, regex = _parse_options(argstr, _count_options)
+
+    if regex:
+        matcher = _compile(regex, '--linear' in options)
+    elif state.matcher:
+        matcher = state.matcher
+    else:
+        raise commands.exceptions.Execute('No active grep command, specify a regex')
+
+    result = _get_result(buf, state, matcher)
+
+    entry.info_show('%d matches on %d lines' % (len(result.spans) / 2, result.matching_lines()))
+
+def extract(view, window, entry, argstr):
+    """Copy matching lines to a new document: grep.extract [-n] &lt;regex&gt;
+
+Copies all lines matching a regular expression to a new document, without
+changing the current document. The lines are added in batches as they are
+matched, the number of extracted lines is shown when done.
+
+Options:
+  -n        prefix every line with its line number
+  --linear  match in linear time, see grep"""
+    buf = view.get_buffer()
+    options, regex = _parse_options(argstr, _extract_options)
+
+    matcher = _compile(regex, '--linear' in options)
+    tab = window.create_tab(False)
+
+    job = _Extract(buf, matcher, tab.get_document(), entry, '-n' in options)
+    yield job.suspend
+
+    if job.error:
+        raise commands.exceptions.Execute(job.error)
+
+def files(window, entry, argstr):
+    """Search the files in a directory: grep.files &lt;directory&gt; &lt;regex&gt;
+
+Searches all files in a directory and its subdirectories for lines matching a
+regular expression, without opening them. Matching lines are listed as
+path:line: text in a new document as they are found. Double click a result, or
+use grep.goto, to open the file at that line.
+
+Binary files and files larger than 256 MB are skipped."""
+    parts = argstr.split(None, 1)
+
+    if len(parts) != 2:
+        raise commands.exceptions.Execute('Specify a directory and a regex')
+
+    directory = os.path.abspath(os.path.expanduser(parts[0]))
+
+    if not os.path.isdir(directory):
+        raise commands.exceptions.Execute('Not a directory: ' + parts[0])
+
+    matcher = _create_file_matcher(_unicode(parts[1]))
+
+    tab = window.create_tab(False)
+    doc = tab.get_document()
+
+    setattr(doc, FilesStateName, directory)
+    tab.get_view().connect('button-press-event', _on_results_button_press, window)
+
+    yield _FileSearch(directory, matcher, doc, entry).suspend
+
+def goto(view, window):
+    """Open the file of a grep.files result: grep.goto
+
+Opens the file of the grep.files result on the line of the cursor, at the line
+of the result."""
+    buf = view.get_buffer()
+
+    if not _open_result(window, buf, buf.get_iter_at_mark(buf.get_insert()).get_line()):
+        raise commands.exceptions.Execute('No grep.files result on this line')
+
+def live(view):
+    """Keep the last grep up to date while editing: grep.live
+
+Toggles live mode for the active grep command. While live, every edit causes
+only the lines it touched to be matched and tagged again."""
+    buf = view.get_buffer()
+    state = _get_state(buf)
+
+    if state.handlers:
+        _live_stop(buf, state)
+    elif state.matcher is None:
+        raise commands.exceptions.Execute('No active grep command, run grep first')
+    elif state.matcher.risky:
+        raise commands.exceptions.Execute('Live and follow mode need --linear for this regular expression')
+    else:
+        _live_start(buf, state)
+
+def follow(view):
+    """Apply the last grep to text appended to the document: grep.follow
+
+Toggles follow mode for the active grep command, for logs that keep growing.
+While following, text added at the end of the document is matched and tagged
+without going over the rest again, also when the document is reloaded and its
+start did not change. Other edits cause the whole document to be matched."""
+    buf = view.get_buffer()
+    state = _get_state(buf)
+
+    if state.follow:
+        _follow_stop(buf, state)
+    elif state.matcher is None:
+        raise commands.exceptions.Execute('No active grep command, run grep first')
+    elif state.matcher.risky:
+        raise commands.exceptions.Execute('Live and follow mode need --linear for this regular expression')
+    else:
+        _follow_start(buf, state)
+
+def clear(view):
+    """Clear the last grep command: grep.clear
+
+Clear the actions resulting from the last grep command. This also stops live
+and follow mode."""
+    buf = view.get_buffer()
+    state = _get_state(buf)
+
+    if state.job:
+        state.job.cancel()
+
+    _live_stop(buf, state)
+    _follow_stop(buf, state)
+    state.matcher = None
 
-    buf.remove_tag(_get_highlight_tag(buf), buf.get_start_iter(), buf.get_end_iter())
-    buf.remove_tag(_get_invisible_tag(buf), buf.get_start_iter(), buf.get_end_iter())
-    buf.remove_tag(_get_zoomout_tag(buf), buf.get_start_iter(), buf.get_end_iter())
+    _clear_tag(buf, state, _get_highlight_tag(buf))
+    _clear_tag(buf, state, _get_invisible_tag(buf))
+    _clear_tag(buf, state, _get_zoomout_tag(buf))
 
 locals()['show'] = __default__
 locals()['zoom'] = zoomin
+locals()['all'] = all_documents
+locals()['next'] = next_match
+locals()['prev'] = previous_match
 
 # vi:ts=4:et
@@ -5,182 +5,633 @@ import commander.commands.exceptions
 
 import re
 import os
+import sys
+import array
+import threading
+import Queue
+
+try:
+    from gi.repository import GLib as glib
+except ImportError:
+    import glib
+
+import _clex
 
 __commander_module__ = True
 
-class Argument:
+# Regions of at least ThreadThreshold characters are indented on a worker
+# thread
+ThreadThreshold = 256 * 1024
+
+_not_space_re = re.compile(r'\S', re.U)
+_space_re = re.compile(r'\s+')
+
+# Blank lines and preprocessor lines between declarations
+_group_break_re = re.compile(r'\n[ \t\r]*\n|^[ \t]*\#', re.M)
+
+# Tokens of C declarations, after whitespace. Every alternative matches in
+# linear time. A # is only a preprocessor line at the start of a line.
+_decl_token_re = re.compile(r'''
+    \s*(?P<pp>^[ \t]*\#(?:[^\n\\]|\\.)*)
+  | \s*(?:(?P<comment>/\*.*?(?:\*/|\Z)|//[^\n]*)
+         | (?P<string>"(?:[^"\\\n]|\\.)*"?|'(?:[^'\\\n]|\\.)*'?)
+         | (?P<ident>[A-Za-z_]\w*)
+         | (?P<number>\.?\d(?:[eEpP][+-]|[\w.])*)
+         | (?P<ellipsis>\.\.\.)
+         | (?P<punct>\S))
+''', re.X | re.S | re.M | re.U)
+
+# Kinds of tokens, punctuation is its own kind
+_token_kinds = {
+    'comment': 'c',
+    'pp': 'p',
+    'string': 's',
+    'ident': 'i',
+    'number': 'n',
+    'ellipsis': '...'
+}
+
+# Tokens ending a declaration
+_boundaries = set([';', '{', '}', 'p'])
+
+_openers = set('([{')
+_closers = set(')]}')
+
+class Argument(object):
+    __slots__ = ('typ', 'ptr', 'name')
+
     def __init__(self, typ, ptr, name):
-        self.typ = re.sub('\s+', ' ', typ.strip())
+        self.typ = _space_re.sub(' ', typ.strip())
         self.ptr = ptr
         self.name = name
 
-    def typ_len(self):
-        return len(self.typ)
+class Declaration(object):
+    __slots__ = ('start', 'name_start', 'args_start', 'args_end',
+                 'typ', 'ptr', 'name', 'args')
 
-    def name_len(self):
-        return len(self.name)
+    def __init__(self, text, decl):
+        typ_start, typ_end, name_start, name_end, args_start, args_end, ptr, args = decl
 
-    def ptr_len(self):
-        return len(self.ptr)
+        # The type is replaced from the start of its line, up to the name.
+        # The name is replaced up to the arguments.
+        self.start = text.rfind('\n', 0, typ_start) + 1
+        self.name_start = name_start
+        self.args_start = args_start
+        self.args_end = args_end
 
-class Declaration:
-    def __init__(self, buf, start, match):
-        self.match = match
+        self.typ = _space_re.sub(' ', text[typ_start:typ_end])
+        self.ptr = ptr
+        self.name = text[name_start:name_end]
+        self.args = args
 
-        argre = re.compile('^(.+?)([ *]+)([a-z_][a-z0-9_]*)$')
+    def align(self, out, widths, typenl = False):
+        """Append the aligned text of the declaration, from its start up to the
+        end of its arguments, to the list out. widths are the widths of the
+        columns, see _Table.widths."""
+        typlen, ptrlen, namelen, atlen, aplen, anlen = widths
 
-        self.typ = re.sub('\s+', ' ', match.group(1).strip())
-        self.ptr = match.group(2).strip()
-        self.name = match.group(3).strip()
-        self.args = [self.match_arg(argre, x.strip()) for x in match.group(4).split(',')]
+        typdiff = typlen - len(self.typ)
+        ptrdiff = ptrlen - len(self.ptr)
+        namediff = namelen - len(self.name)
 
-        self.max_argtyp = max(self.args, key=lambda x: x.typ_len())
-        self.max_argname = max(self.args, key=lambda x: x.name_len())
-        self.max_argptr = max(self.args, key=lambda x: x.ptr_len())
+        if not typenl:
+            typ = '%s %s%s' % (self.typ, ' ' * (typdiff + ptrdiff), self.ptr)
+        else:
+            typ = self.typ
 
-        self.typ_marks = self.create_marks(buf, start, match, 1, 2, True)
-        self.name_marks = self.create_marks(buf, start, match, 3, 3, False)
-        self.args_marks = self.create_marks(buf, start, match, 4, 4, False)
+            if self.ptr:
+                typ += ' ' + self.ptr
 
-    def match_arg(self, argre, arg):
-        if arg == 'void':
-            return Argument(arg, '', '')
-        else:
-            match = argre.match(arg)
+            typ += "\n"
 
-            return Argument(match.group(1), match.group(2).replace(' ', ''), match.group(3))
+        out.append(typ)
 
-    def ptr_len(self):
-        return len(self.ptr)
+        name = '%s%s ' % (self.name, ' ' * namediff)
 
-    def typ_len(self):
-        return len(self.typ)
+        out.append(name)
+        out.append('(')
 
-    def name_len(self):
-        return len(self.name)
+        offset = _line_offset(out)
 
-    def argtyp_len(self):
-        return self.max_argtyp.typ_len()
+        args = []
 
-    def argname_len(self):
-        return self.max_argname.name_len()
+        for i in xrange(0, len(self.args)):
+            a = self.args[i]
+            arg = ''
 
-    def argptr_len(self):
-        return self.max_argptr.ptr_len()
+            atypdiff = atlen - len(a.typ)
+            aptrdiff = aplen - len(a.ptr)
 
-    def create_marks(self, buf, start, match, grps, grpe, linestart):
-        start = start.copy()
-        end = start.copy()
+            if i != 0:
+                arg += ' ' * offset
 
-        start.forward_chars(match.start(grps))
+            if a.name:
+                typ = '%s %s%s' % (a.typ, ' ' * (atypdiff + aptrdiff), a.ptr)
+            else:
+                typ = a.typ
 
-        if linestart and not start.starts_line():
-            start.set_line_offset(0)
+            arg += typ + a.name
+            args.append(arg)
 
-        end.forward_chars(match.end(grpe))
+        out.append(('%s%s' % (',', os.linesep)).join(args))
 
-        mstart = buf.create_mark(None, start, False)
-        mend = buf.create_mark(None, end, False)
+class _Table:
+    """The declarations in a text, with the lengths of their fields stored
+    column wise, in one array per field. The arguments of all declarations
+    are in one list, args_index has the index of the first argument of every
+    declaration (and the number of arguments at the end)."""
 
-        return [mstart, mend]
+    def __init__(self, text, isdecl):
+        self.decls = []
+        self.args = []
+        self.args_index = array.array('l', [0])
 
-    def replace(self, buf, marks, s):
-        start = buf.get_iter_at_mark(marks[0])
-        end = buf.get_iter_at_mark(marks[1])
+        for parsed in _parse_declarations(text, isdecl):
+            decl = Declaration(text, parsed)
 
-        buf.delete(start, end)
-        buf.insert(start, s)
+            self.decls.append(decl)
+            self.args.extend(decl.args)
+            self.args_index.append(len(self.args))
 
-        buf.delete_mark(marks[0])
-        buf.delete_mark(marks[1])
+        self.typ = array.array('l', [len(d.typ) for d in self.decls])
+        self.ptr = array.array('l', [len(d.ptr) for d in self.decls])
+        self.name = array.array('l', [len(d.name) for d in self.decls])
 
-    def align(self, buf, typlen, ptrlen, namelen, argtyplen, argptrlen, argnamelen, typenl = False):
-        tlen = typlen.typ_len()
+        self.argtyp = array.array('l', [len(a.typ) for a in self.args])
+        self.argptr = array.array('l', [len(a.ptr) for a in self.args])
+        self.argname = array.array('l', [len(a.name) for a in self.args])
 
-        typdiff = typlen.typ_len() - self.typ_len()
-        ptrdiff = ptrlen.ptr_len() - self.ptr_len()
-        namediff = namelen.name_len() - self.name_len()
+    def widths(self, first=0, last=None):
+        """Widths of the columns of the declarations from index first up to
+        last: the type, pointer and name, and those of the arguments"""
+        if last is None:
+            last = len(self.decls)
 
-        if not typenl:
-            typ = '%s %s%s' % (self.typ, ' ' * (typdiff + ptrdiff), self.ptr)
+        a = self.args_index[first]
+        b = self.args_index[last]
+
+        return (max(self.typ[first:last]),
+                max(self.ptr[first:last]),
+                max(self.name[first:last]),
+                max(self.argtyp[a:b]),
+                max(self.argptr[a:b]),
+                max(self.argname[a:b]))
+
+def _line_offset(pieces):
+    # Length of the last line of the joined pieces
+    n = 0
+
+    for piece in reversed(pieces):
+        i = piece.rfind('\n')
+
+        if i >= 0:
+            return n + len(piece) - i - 1
+
+        n += len(piece)
+
+    return n
+
+def _common_prefix(a, b):
+    lo = 0
+    hi = min(len(a), len(b))
+
+    # Bisect on slices, comparing them is much faster than a loop over the
+    # characters
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+
+        if a[:mid] == b[:mid]:
+            lo = mid
         else:
-            typ = self.typ
+            hi = mid - 1
 
-            if self.ptr:
-                typ += ' ' + self.ptr
+    return lo
 
-            typ += "\n"
+def _common_suffix(a, b, limit):
+    lo = 0
+    hi = min(len(a), len(b), limit)
 
-        self.replace(buf, self.typ_marks, typ)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
 
-        name = '%s%s ' % (self.name, ' ' * namediff)
+        if a[len(a) - mid:] == b[len(b) - mid:]:
+            lo = mid
+        else:
+            hi = mid - 1
 
-        self.replace(buf, self.name_marks, name)
+    return lo
 
-        iter = buf.get_iter_at_mark(self.args_marks[0])
-        offset = iter.get_line_offset()
+def _replace_text(buf, start, old, new):
+    # Replace the text old at offset start by new, as a single edit of only
+    # the part that differs
+    prefix = _common_prefix(old, new)
 
-        args = []
+    if prefix == len(old) == len(new):
+        return
 
-        atlen = argtyplen.argtyp_len()
-        aplen = argptrlen.argptr_len()
-        anlen = argnamelen.argname_len()
+    suffix = _common_suffix(old, new, min(len(old), len(new)) - prefix)
 
-        for i in xrange(0, len(self.args)):
-            a = self.args[i]
-            arg = ''
+    piter = buf.get_iter_at_offset(start + prefix)
 
-            atypdiff = atlen - a.typ_len()
-            aptrdiff = aplen - a.ptr_len()
-            anamediff = anlen - a.name_len()
+    if prefix < len(old) - suffix:
+        buf.delete(piter, buf.get_iter_at_offset(start + len(old) - suffix))
 
-            if i != 0:
-                arg += ' ' * offset
+    if prefix < len(new) - suffix:
+        buf.insert(piter, new[prefix:len(new) - suffix])
 
-            if a.name:
-                typ = '%s %s%s' % (a.typ, ' ' * (atypdiff + aptrdiff), a.ptr)
-            else:
-                typ = a.typ
+def _tokenize(text):
+    # List of (kind, start, end) of the tokens in text, the kind of
+    # punctuation is the punctuation itself
+    kinds = _token_kinds
 
-            arg += typ + a.name
-            args.append(arg)
+    return [(kinds.get(m.lastgroup) or m.group(0)[-1], m.start(m.lastgroup), m.end(0))
+            for m in _decl_token_re.finditer(text)]
 
-        self.replace(buf, self.args_marks, ('%s%s' % (',', os.linesep)).join(args))
+def _skip_to(tokens, i, kinds):
+    # Index of the first token from i of one of kinds, or the number of tokens
+    while i < len(tokens) and not tokens[i][0] in kinds:
+        i += 1
 
-def _find_not_space(find):
-    return not find.get_char().isspace()
+    return i
 
-def _find_not_char(ch, *ignore_classes):
-    def _anon_generator(find):
-        for c in ignore_classes:
-            if find.get_buffer().iter_has_context_class(find, c):
-                return False
+def _match_paren(tokens, i):
+    # Index of the parenthesis closing the one at i, or the index of the
+    # declaration boundary or end where it was not found
+    depth = 0
+
+    while i < len(tokens):
+        kind = tokens[i][0]
+
+        if kind == '(':
+            depth += 1
+        elif kind == ')':
+            depth -= 1
+
+            if depth == 0:
+                break
+        elif kind in _boundaries:
+            break
+
+        i += 1
+
+    return i
+
+def _parse_argument(text, tokens):
+    code = [t for t in tokens if t[0] != 'c']
+
+    if not code:
+        return Argument('', '', '')
+
+    whole = text[tokens[0][1]:tokens[-1][2]]
+
+    if '(' in [t[0] for t in code]:
+        # Function pointers and macros are kept as they are
+        return Argument(whole, '', '')
+
+    # The name is the last identifier, only followed by array dimensions
+    k = len(code) - 1
+    depth = 0
+
+    while k > 0 and (depth > 0 or code[k][0] == ']'):
+        if code[k][0] == ']':
+            depth += 1
+        elif code[k][0] == '[':
+            depth -= 1
+
+        k -= 1
+
+    if k == 0 or code[k][0] != 'i':
+        return Argument(whole, '', '')
+
+    p = k
+
+    while p > 0 and code[p - 1][0] == '*':
+        p -= 1
+
+    if p == 0:
+        return Argument(whole, '', '')
+
+    return Argument(text[tokens[0][1]:code[p - 1][2]],
+                    '*' * (k - p),
+                    text[code[k][1]:tokens[-1][2]])
+
+def _parse_arguments(text, tokens):
+    args = []
+    depth = 0
+    first = 0
+
+    for i in xrange(len(tokens)):
+        kind = tokens[i][0]
 
-        return find.get_char() != ch
+        if kind in _openers:
+            depth += 1
+        elif kind in _closers:
+            depth -= 1
+        elif kind == ',' and depth == 0:
+            args.append(_parse_argument(text, tokens[first:i]))
+            first = i + 1
+
+    args.append(_parse_argument(text, tokens[first:]))
+    return args
+
+def _parse_declarations(text, isdecl):
+    """Parse the function declarations in text, one token at a time. Yields
+    the start and end offsets of the type, the name and the arguments, the
+    pointer stars before the name and the parsed arguments. Declarations need
+    to end in a ; when isdecl is set."""
+    tokens = _tokenize(text)
+    n = len(tokens)
+    i = 0
+
+    while i < n:
+        kind = tokens[i][0]
+
+        # Comments before a declaration are not part of it
+        if kind in _boundaries or kind == 'c':
+            i += 1
+            continue
+
+        first = i
+        paren = _skip_to(tokens, i, _boundaries | set('('))
+
+        if paren == n or tokens[paren][0] != '(':
+            i = paren
+            continue
+
+        close = _match_paren(tokens, paren)
+        i = _skip_to(tokens, close, _boundaries)
+
+        if close == n or tokens[close][0] != ')':
+            continue
+
+        if isdecl and (i == n or tokens[i][0] != ';'):
+            continue
+
+        # The name directly precedes the arguments, after the pointer stars
+        name = paren - 1
+
+        while name > first and tokens[name][0] == 'c':
+            name -= 1
+
+        if tokens[name][0] != 'i':
+            continue
+
+        stars = name
+
+        while stars > first and tokens[stars - 1][0] in ('*', 'c'):
+            stars -= 1
+
+        if stars == first:
+            continue
+
+        ptr = '*' * len([t for t in tokens[stars:name] if t[0] == '*'])
+
+        yield (tokens[first][1],
+               tokens[stars - 1][2],
+               tokens[name][1],
+               tokens[name][2],
+               tokens[paren][2],
+               tokens[close][1],
+               ptr,
+               _parse_arguments(text, tokens[paren + 1:close]))
+
+# Finders take the lexical index of the buffer and the offsets to search
+# between, and return the offset that was found or -1
+
+def _find_not_char(ch, *ignore_classes):
+    def _anon_generator(index, start, end):
+        return index.find_not(ch, start, end, ignore_classes)
 
     return _anon_generator
 
 def _find_char(ch, *ignore_classes):
-    def _anon_generator(find):
-        for c in ignore_classes:
-            if find.get_buffer().iter_has_context_class(find, c):
-                return False
-
-        return find.get_char() == ch
+    def _anon_generator(index, start, end):
+        return index.find(ch, start, end, ignore_classes)
 
     return _anon_generator
 
 def _forward_find_char(iter, cb, end=None):
+    buf = iter.get_buffer()
+
     if not end:
-        end = iter.get_buffer().get_end_iter()
+        end = buf.get_end_iter()
+
+    offset = cb(_clex.get(buf), iter.get_offset(), end.get_offset())
+
+    if offset < 0:
+        if iter.compare(end) < 0:
+            iter.set_offset(end.get_offset())
+
+        return False
+
+    iter.set_offset(offset)
+    return True
 
-    while iter.compare(end) < 0:
-        if cb(iter):
+def _break_call(text):
+    """Break the arguments of the first call in text over separate lines,
+    indented to just after its opening parenthesis. Returns None when there is
+    no call."""
+    index = _clex.Index(text)
+
+    start = index.search(_not_space_re, 0)
+
+    if start < 0:
+        return None
+
+    # Find where to indent on
+    indenton = index.find('(', start, None, ('comment', 'string'))
+
+    if indenton < 0:
+        return None
+
+    indenton += 1
+
+    # Find breakers
+    breakers = []
+    ptr = indenton
+
+    while True:
+        ptr = index.find(',', ptr, None, ('comment', 'string'))
+
+        if ptr < 0:
+            break
+
+        breakers.append(ptr)
+        ptr += 1
+
+    if not breakers:
+        raise commander.commands.exceptions.Execute('Nothing to indent')
+
+    indent = text[:start] + ((indenton - start) * ' ')
+    parts = [text[:breakers[0]]]
+
+    for br in range(1, len(breakers)):
+        parts.append(text[breakers[br - 1] + 1:breakers[br]].strip())
+
+    parts.append(text[breakers[-1] + 1:].lstrip())
+
+    return (',\n%s' % (indent,)).join(parts)
+
+def _align(text, table, groups, typenl):
+    # Align the declarations of table in text, every group of declarations
+    # (as a range of indices) to its own columns. Returns the start and end of
+    # every declaration in text with its aligned text.
+    out = []
+    hunks = []
+    pos = 0
+
+    for first, last in groups:
+        widths = table.widths(first, last)
+
+        for decl in table.decls[first:last]:
+            # A declaration sharing its line with the previous one is kept as
+            # it is
+            if decl.start < pos:
+                continue
+
+            out.append(text[pos:decl.start])
+
+            # The text before it on its line is needed to indent its arguments
+            n = len(out)
+            decl.align(out, widths, typenl)
+
+            hunks.append((decl.start, decl.args_end, u''.join(out[n:])))
+            pos = decl.args_end
+
+    return hunks
+
+def _apply_hunks(text, hunks):
+    out = []
+    pos = 0
+
+    for start, end, new in hunks:
+        out.append(text[pos:start])
+        out.append(new)
+
+        pos = end
+
+    out.append(text[pos:])
+    return u''.join(out)
+
+def _merge_hunks(text, hunks):
+    # Drop the hunks that do not change anything and join the others that
+    # are on consecutive lines, so that a block of changed declarations is
+    # replaced at once
+    merged = []
+
+    for start, end, new in hunks:
+        if new == text[start:end]:
+            continue
+
+        if merged and text.count('\n', merged[-1][1], start) <= 1:
+            pstart, pend, pnew = merged[-1]
+            merged[-1] = (pstart, end, pnew + text[pend:start] + new)
+        else:
+            merged.append((start, end, new))
+
+    return merged
+
+def _align_declarations(text, isdecl):
+    """Align the types, names and arguments of the declarations in text"""
+    table = _Table(text, isdecl)
+
+    if not table.decls:
+        return text
+
+    return _apply_hunks(text, _align(text, table, [(0, len(table.decls))], not isdecl))
+
+def _align_groups(text):
+    """Align the declarations in text, where runs of declarations separated by
+    blank lines or preprocessor lines are aligned on their own. Returns the
+    hunks of _align."""
+    table = _Table(text, True)
+    decls = table.decls
+
+    groups = []
+    first = 0
+
+    for i in xrange(1, len(decls)):
+        if _group_break_re.search(text, decls[i - 1].args_end, decls[i].start):
+            groups.append((first, i))
+            first = i
+
+    if decls:
+        groups.append((first, len(decls)))
+
+    return _align(text, table, groups, False)
+
+class _Job:
+    """Runs one of the functions above on a snapshot of the text of a buffer.
+    Snapshots of at least ThreadThreshold characters are handled on a worker
+    thread while the main loop keeps running. The result only applies when
+    the buffer did not change in the meantime."""
+
+    def __init__(self, buf, func, text, *args):
+        self.buf = buf
+        self.version = _clex.version(buf)
+        self.queue = Queue.Queue()
+        self.outcome = None
+        self.suspend = None
+
+        if len(text) < ThreadThreshold:
+            self._run(func, text, args)
+            self.outcome = self.queue.get()
+            return
+
+        thread = threading.Thread(target=self._run, args=(func, text, args))
+        thread.daemon = True
+        thread.start()
+
+        self.timeout_id = glib.timeout_add(20, self._on_timeout)
+
+        self.suspend = commands.result.Suspend()
+        self.suspend.register(self._on_resume)
+
+    def _run(self, func, text, args):
+        try:
+            self.queue.put((func(text, *args), None))
+        except Exception:
+            self.queue.put((None, sys.exc_info()))
+
+    def _on_timeout(self):
+        try:
+            self.outcome = self.queue.get_nowait()
+        except Queue.Empty:
             return True
 
-        iter.forward_char()
+        self.timeout_id = 0
+        self.suspend.resume()
+
+        return False
 
-    return False
+    def _on_resume(self):
+        # Resumed by commander when cancelled by the user, the thread is left
+        # to finish on its own
+        if self.timeout_id:
+            glib.source_remove(self.timeout_id)
+            self.timeout_id = 0
+
+    def cancelled(self):
+        return self.outcome is None
+
+    def result(self):
+        result, error = self.outcome
+
+        if error:
+            raise error[0], error[1], error[2]
+
+        if _clex.version(self.buf) != self.version:
+            raise commander.commands.exceptions.Execute('The document changed while indenting')
+
+        return result
+
+def _get_text(start, end):
+    text = start.get_text(end)
+
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+
+    return text
 
 def _indent_c(view, entry):
     buf = view.get_buffer()
@@ -197,51 +648,27 @@ def _indent_c(view, entry):
     if not bounds[1].ends_line():
         bounds[1].forward_to_line_end()
 
-    # Find first thingie
-    start = bounds[0].copy()
-
-    if not _forward_find_char(start, _find_not_space, bounds[1]):
-        # Try indenting cfunc instead
-        return _indent_cdecl_real(view, entry, False)
-
-    # Find where to indent on
-    indenton = start.copy()
-
-    if not _forward_find_char(indenton, _find_char('(', 'comment', 'string'), bounds[1]):
-        # Try indenting cfunc instead
-        return _indent_cdecl_real(view, entry, False)
+    offset = bounds[0].get_offset()
+    text = _get_text(bounds[0], bounds[1])
 
-    indenton.forward_char()
+    job = _Job(buf, _break_call, text)
 
-    # Find breakers
-    ptr = indenton.copy()
-    breakers = []
+    if job.suspend:
+        yield job.suspend
 
-    while True:
-        if not _forward_find_char(ptr, _find_char(',', 'comment', 'string'), bounds[1]):
-            break
+    if job.cancelled():
+        return
 
-        breakers.append(ptr.get_offset() - bounds[0].get_offset())
+    result = job.result()
 
-        if not ptr.forward_char():
-            break
-
-    indent = bounds[0].get_text(start) + ((indenton.get_offset() - start.get_offset()) * ' ')
-    text = bounds[0].get_text(bounds[1])
-
-    if breakers:
-        buf.begin_user_action()
-        buf.delete(buf.get_iter_at_offset(breakers[0] + bounds[0].get_offset()), bounds[1])
-
-        for br in range(1, len(breakers)):
-            tt = text[breakers[br - 1] + 1:breakers[br]].strip()
-
-            buf.insert(bounds[1], ',\n%s%s' % (indent, tt))
+    if result is None:
+        # Try indenting cfunc instead
+        yield _indent_cdecl_real(view, entry, False)
+        return
 
-        buf.insert(bounds[1], text[breakers[-1] + 1:])
-        buf.end_user_action()
-    else:
-        raise commander.commands.exceptions.Execute('Nothing to indent')
+    buf.begin_user_action()
+    _replace_text(buf, offset, text, result)
+    buf.end_user_action()
 
 def _indent_cdecl_real(view, entry, isdecl):
     buf = view.get_buffer()
@@ -264,8 +691,7 @@ def _indent_cdecl_real(view, entry, isdecl):
 
         reselect = True
 
-    marks = [buf.create_mark(None, start, True),
-             buf.create_mark(None, end, False)]
+    selection = (start.get_offset(), end.get_offset())
 
     if not start.starts_line():
         start.set_line_offset(0)
@@ -273,53 +699,27 @@ def _indent_cdecl_real(view, entry, isdecl):
     if not end.ends_line():
         end.forward_to_line_end()
 
-    reg = '\s*([^(]+?)(\**)([a-z_][a-z0-9_]*\s*)\(([^)]*)\)'
-
-    if isdecl:
-        reg += '[^;]*;\s*'
-
-    r = re.compile(reg, re.M)
-
-    text = start.get_text(end)
-    repl = re.compile('\s+')
+    offset = start.get_offset()
+    text = _get_text(start, end)
 
-    typlen = None
-    namelen = None
-    ptrlen = None
-    argtyplen = None
-    argnamelen = None
-    argptrlen = None
+    job = _Job(buf, _align_declarations, text, isdecl)
 
-    decls = []
+    if job.suspend:
+        yield job.suspend
 
-    for m in r.finditer(text):
-        decl = Declaration(buf, start, m)
+    if job.cancelled():
+        return
 
-        if not typlen or decl.typ_len() > typlen.typ_len():
-            typlen = decl
+    result = job.result()
 
-        if not ptrlen or decl.ptr_len() > ptrlen.ptr_len():
-            ptrlen = decl
-
-        if not namelen or decl.name_len() > namelen.name_len():
-            namelen = decl
-
-        if not argtyplen or decl.argtyp_len() > argtyplen.argtyp_len():
-            argtyplen = decl
-
-        if not argnamelen or decl.argname_len() > argnamelen.argname_len():
-            argnamelen = decl
-
-        if not argptrlen or decl.argptr_len() > argptrlen.argptr_len():
-            argptrlen = decl
-
-        decls.append(decl)
+    # The buffer did not change, so the offsets still apply
+    marks = [buf.create_mark(None, buf.get_iter_at_offset(selection[0]), True),
+             buf.create_mark(None, buf.get_iter_at_offset(selection[1]), False)]
 
     buf.begin_user_action()
 
-    # Replace everything
-    for decl in decls:
-        decl.align(buf, typlen, ptrlen, namelen, argtyplen, argptrlen, argnamelen, not isdecl)
+    # Only change the buffer where the aligned text differs
+    _replace_text(buf, offset, text, result)
 
     if reselect:
         buf.select_range(buf.get_iter_at_mark(marks[0]),
@@ -333,7 +733,7 @@ def _indent_cdecl_real(view, entry, isdecl):
     buf.end_user_action()
 
 def _indent_cdecl(view, entry):
-    return _indent_cdecl_real(view, entry, True)
+    yield _indent_cdecl_real(view, entry, True)
 
 _language_handlers = {
     'c': _indent_c,
@@ -351,12 +751,47 @@ def __default__(view, entry):
     if not lang in _language_handlers:
         raise commander.commands.exceptions.Execute('Indentation rules not available for this language')
 
-    return _language_handlers[lang](view, entry)
+    yield _language_handlers[lang](view, entry)
 
 def cdecl(view, entry):
-    return _indent_cdecl(view, entry)
+    yield _indent_cdecl(view, entry)
 
 def cfunc(view, entry):
-    return _indent_cdecl_real(view, entry, False)
+    yield _indent_cdecl_real(view, entry, False)
+
+def cdecl_all(view, entry):
+    """Align all declarations in the document: indent.cdecl-all
+
+Aligns the function declarations in the whole document, like indent.cdecl.
+Runs of declarations separated by blank lines or preprocessor lines are aligned
+on their own."""
+    buf = view.get_buffer()
+    text = _get_text(buf.get_start_iter(), buf.get_end_iter())
+
+    job = _Job(buf, _align_groups, text)
+
+    if job.suspend:
+        yield job.suspend
+
+    if job.cancelled():
+        return
+
+    hunks = job.result()
+    mark = buf.create_mark(None, buf.get_iter_at_mark(buf.get_insert()), True)
+
+    buf.begin_user_action()
+
+    # Only the blocks of declarations that changed are edited, from the last
+    # one on so that the offsets of the others still apply. Marks elsewhere
+    # stay put and only the edited lines have to be highlighted again.
+    for start, end, new in reversed(_merge_hunks(text, hunks)):
+        _replace_text(buf, start, text[start:end], new)
+
+    buf.place_cursor(buf.get_iter_at_mark(mark))
+
+    buf.delete_mark(mark)
+    buf.end_user_action()
+
+locals()['cdecl-all'] = cdecl_all
 
 # vi:ex:ts=4:et